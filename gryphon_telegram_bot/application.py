@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+from pathlib import Path
+from time import perf_counter
+
+from telegram import Update
+from telegram.ext import Application
+
+from .cards import LiveCards
+from .hibernation import Hibernation
+from .history import DEFAULT_HISTORY_LIMIT
+from .journal import Journal, JsonlJournal
+from .locks import ChatLocks
+from .metrics import Metrics, PrometheusMetrics
+from .outbox import DEFAULT_CHAT_RATE, DEFAULT_GLOBAL_RATE, Outbox
+from .profiling import DEFAULT_SNAPSHOT_INTERVAL, CProfileProfiler, Profiler
+from .stats import ShardStats, Stats, get_global_stats
+
+DEFAULT_WARMUP = 60.
+
+
+class GryphonApplication(Application):
+    """Application that also carries the bot's runtime settings, available to callbacks as context.application."""
+
+    def __init__(self, history_limit: int = DEFAULT_HISTORY_LIMIT, global_rate: float = DEFAULT_GLOBAL_RATE,
+                 chat_rate: float = DEFAULT_CHAT_RATE, metrics_port: int = None, hibernate_after: float = None,
+                 warmup: float = DEFAULT_WARMUP, journal_path: Path = None, profile_path: Path = None,
+                 profile_interval: float = DEFAULT_SNAPSHOT_INTERVAL, slow_threshold: float = None,
+                 live_card: bool = False, shard_stats_path: Path = None, **kwargs):
+        """
+        :param shard_stats_path: When running as one of several shards, save this shard's global stats to this file,
+                                 and add up the stats in the other files of its directory to show stats of all chats
+        :param live_card: Keep one message per chat showing its gryphon, edited at most chat_rate times per second,
+                          instead of sending a message for everything that happens
+        :param profile_path: Profile the bot and write snapshots to this directory every profile_interval seconds, if
+                             given
+        :param slow_threshold: Log handler calls and job ticks that take at least this many seconds, if given
+        :param journal_path: Record what happens to gryphons in a journal in this directory, if given
+        :param warmup: Seconds over which to spread notifications for events that finished while the bot was stopped
+        :param metrics_port: Serve Prometheus metrics on this port, if given
+        :param hibernate_after: Evict chats from memory after this many seconds without updates, if given. Needs
+                                SQLitePersistence.
+        """
+        super().__init__(**kwargs)
+        self.history_limit = history_limit
+        self.warmup = warmup
+        self.chat_locks = ChatLocks()
+        self.outbox = Outbox(self.bot, global_rate=global_rate, chat_rate=chat_rate)
+        self.journal = Journal() if journal_path is None else JsonlJournal(journal_path)
+        self.hibernation = None if hibernate_after is None else Hibernation(hibernate_after)
+        self.cards = LiveCards(self, interval=1 / chat_rate) if live_card else None
+        self.shard_stats = None if shard_stats_path is None else ShardStats(shard_stats_path)
+        self.metrics = Metrics() if metrics_port is None else PrometheusMetrics(self, metrics_port)
+        self.profiler = Profiler(slow_threshold) if profile_path is None else \
+            CProfileProfiler(profile_path, profile_interval, slow_threshold)
+
+    async def process_update(self, update: object) -> None:
+        if not isinstance(update, Update) or update.effective_chat is None:
+            await super().process_update(update)
+            return
+        chat_id = update.effective_chat.id
+        # Before anything is awaited, so the chat can't be hibernated while the update is being handled
+        if self.hibernation is not None:
+            self.hibernation.touch(chat_id)
+        # Updates for the same chat are processed one at a time. Holding the lock only around callbacks isn't enough:
+        # the conversation handler reads a conversation's state before its callback runs and saves the new one after.
+        async with self.chat_locks(chat_id):
+            await super().process_update(update)
+
+    def global_stats(self) -> Stats:
+        """Stats of all chats, including those of other shards"""
+        stats = get_global_stats(self.bot_data)
+        return stats if self.shard_stats is None else self.shard_stats.total(stats)
+
+    def hibernate_chat(self, chat_id: int) -> None:
+        """Save the chat's data and drop it from memory, until its next update or job loads it again."""
+        self._chat_ids_to_be_updated_in_persistence.discard(chat_id)
+        self.persistence.evict_chat_data(chat_id, self._chat_data.pop(chat_id))
+
+    async def update_persistence(self) -> None:
+        start = perf_counter()
+        await super().update_persistence()
+        seconds = perf_counter() - start
+        self.metrics.observe_persistence_flush(seconds)
+        self.profiler.observe('persistence flush', seconds)
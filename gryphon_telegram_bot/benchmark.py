@@ -0,0 +1,224 @@
+"""
+Offline load test: drives the bot's handlers with simulated chats against a stand-in for the Bot API, and reports
+handler latency, event completion time, memory and persistence size as JSON.
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import logging
+import random
+import tempfile
+import tracemalloc
+from copy import deepcopy
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from time import perf_counter, time
+from typing import Optional
+
+import typer
+from typing_extensions import Annotated
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+from .main import PersistenceBackend, build_application, make_persistence, update_gryphon
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Gryphon', 'username': 'gryphon_bot',
+            'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+
+class FakeBotAPI(BaseRequest):
+    """Answers Bot API requests locally, remembering the last keyboard sent to each chat."""
+
+    def __init__(self, latency: float = 0.):
+        """
+        :param latency: Seconds to wait before answering each request, to simulate network round trips
+        """
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.keyboards: dict[int, list[dict]] = {}
+        self.calls: dict[str, int] = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint == 'getMe':
+            result = BOT_USER
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            chat_id = parameters.get('chat_id', 0)
+            markup = parameters.get('reply_markup')
+            if markup:
+                self.keyboards[chat_id] = [button for row in markup['inline_keyboard'] for button in row]
+            result = {'message_id': parameters.get('message_id') or next(self.message_ids), 'date': int(time()),
+                      'chat': {'id': chat_id, 'type': 'group', 'title': 'Benchmark'}, 'from': BOT_USER,
+                      'text': parameters.get('text', '')}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class Driver(object):
+    """Builds updates as if they were sent by users of simulated chats."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+
+    @staticmethod
+    def _chat(chat_id: int) -> dict:
+        return {'id': chat_id, 'type': 'group', 'title': f'Chat {chat_id}'}
+
+    def command(self, chat_id: int, user_id: int, command: str = '/gryphon') -> Update:
+        return Update.de_json({'update_id': next(self.update_ids), 'message': {
+            'message_id': 1, 'date': int(time()), 'chat': self._chat(chat_id), 'from': self._user(user_id),
+            'text': command, 'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]}}, self.bot)
+
+    def callback_query(self, chat_id: int, user_id: int, data: str) -> Update:
+        update_id = next(self.update_ids)
+        return Update.de_json({'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'chat_instance': str(chat_id), 'from': self._user(user_id), 'data': data,
+            'message': {'message_id': 1, 'date': int(time()), 'chat': self._chat(chat_id), 'from': BOT_USER,
+                        'text': 'Menu'}}}, self.bot)
+
+
+def percentiles(samples: list[float]) -> dict:
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    n = len(samples)
+    return {'count': n,
+            'mean_ms': round(1000 * sum(samples) / n, 4),
+            'p50_ms': round(1000 * samples[n // 2], 4),
+            'p99_ms': round(1000 * samples[min(n - 1, int(n * .99))], 4),
+            'max_ms': round(1000 * samples[-1], 4)}
+
+
+async def run_benchmark(chats: int, users: int, rounds: int, backend: PersistenceBackend, latency: float,
+                        seed: int, live_card: bool = False) -> dict:
+    random.seed(seed)
+    api = FakeBotAPI(latency=latency)
+    with tempfile.TemporaryDirectory() as persistence_path:
+        persistence_path = Path(persistence_path)
+        # Without rate limits on notifications, so stopping doesn't wait for the outbox to drain
+        application = build_application('1:benchmark', make_persistence(persistence_path, backend), request=api,
+                                        global_rate=float('inf'), chat_rate=float('inf'), live_card=live_card)
+        driver = Driver(application.bot)
+        latencies: dict[str, list[float]] = {'gryphon': [], 'new_gryphon': [], 'gryphon_action': [],
+                                             'gryphon_action_parameter': []}
+        tick_durations: list[float] = []
+        flush_durations: list[float] = []
+
+        async def process(handler: str, update: Update) -> None:
+            start = perf_counter()
+            await application.process_update(update)
+            latencies[handler].append(perf_counter() - start)
+
+        async def complete_events() -> None:
+            """Run every scheduled event, as if its deadline had passed."""
+            jobs = [job for job in application.job_queue.jobs() if job.callback is update_gryphon]
+            if not jobs:
+                return
+            for job in jobs:
+                gryphon = application.chat_data[job.chat_id].get('gryphon')
+                if gryphon is not None and gryphon.event_done_time is not None:
+                    gryphon.event_done_time = 0.
+            start = perf_counter()
+            for job in jobs:
+                job.schedule_removal()
+                await job.run(application)
+            tick_durations.append(perf_counter() - start)
+
+        async with application:
+            await application.post_init(application)
+            for _ in range(rounds):
+                for chat_id, user_id in itertools.product(range(1, chats + 1), range(1, users + 1)):
+                    user_id = chat_id * users + user_id
+                    await process('gryphon', driver.command(chat_id, user_id))
+
+                    buttons = api.keyboards.get(chat_id, [])
+                    if not buttons:
+                        continue
+                    if len(buttons) == 1:  # Only offered to summon a new gryphon
+                        await process('new_gryphon', driver.callback_query(chat_id, user_id,
+                                                                           buttons[0]['callback_data']))
+                        continue
+
+                    api.keyboards.pop(chat_id)
+                    button = random.choice(buttons)
+                    await process('gryphon_action', driver.callback_query(chat_id, user_id, button['callback_data']))
+                    if chat_id in api.keyboards:  # The action asked for a parameter
+                        button = random.choice(api.keyboards.pop(chat_id))
+                        await process('gryphon_action_parameter',
+                                      driver.callback_query(chat_id, user_id, button['callback_data']))
+
+                await complete_events()
+                start = perf_counter()
+                await application.update_persistence()
+                flush_durations.append(perf_counter() - start)
+
+            # Memory held by chat data, estimated from what it takes to build a copy of it
+            tracemalloc.start()
+            chat_data_copy = deepcopy(dict(application.chat_data))
+            chat_data_memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del chat_data_copy
+
+            await application.post_stop(application)
+        persistence_size = sum(f.stat().st_size for f in persistence_path.iterdir())
+
+    try:
+        package_version = version('gryphon-telegram-bot')
+    except PackageNotFoundError:
+        package_version = None
+
+    return {'version': package_version,
+            'config': {'chats': chats, 'users_per_chat': users, 'rounds': rounds, 'persistence': backend.value,
+                       'latency_ms': latency * 1000, 'seed': seed, 'live_card': live_card},
+            'handlers': {handler: percentiles(samples) for handler, samples in latencies.items()},
+            'event_ticks': percentiles(tick_durations),
+            'persistence_flush': percentiles(flush_durations),
+            'persistence_bytes': persistence_size,
+            'memory_per_chat_bytes': chat_data_memory // max(chats, 1),
+            'api_calls': api.calls}
+
+
+def benchmark(chats: Annotated[int, typer.Option(help='Number of simulated chats')] = 100,
+              users: Annotated[int, typer.Option(help='Users per chat')] = 2,
+              rounds: Annotated[int, typer.Option(help='Times each user opens the menu and picks an action')] = 5,
+              persistence_backend: Annotated[PersistenceBackend, typer.Option()] = PersistenceBackend.pickle,
+              latency: Annotated[float, typer.Option(help='Simulated Bot API round trip in seconds')] = 0.,
+              seed: Annotated[int, typer.Option(help='Random seed')] = 0,
+              live_card: Annotated[bool, typer.Option(help='Edit a status card per chat instead of notifying')] = False,
+              output: Annotated[Path, typer.Option(help='Write results to this file instead of stdout')] = None) \
+        -> None:
+    """Benchmark the bot against a local stand-in for the Bot API."""
+    logging.getLogger('telegram').setLevel(logging.WARNING)
+    results = asyncio.run(run_benchmark(chats, users, rounds, persistence_backend, latency, seed,
+                                          live_card))
+    if output is None:
+        typer.echo(json.dumps(results, indent=2))
+    else:
+        output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(benchmark)
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from time import monotonic
+from typing import TYPE_CHECKING
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+if TYPE_CHECKING:
+    from .application import GryphonApplication
+    from .gryphon import Gryphon
+
+logger = logging.getLogger(__name__)
+
+# Where a chat's card is kept in its chat data: the card's message id, the text it shows and the latest event
+CARD_KEY = 'live_card'
+
+
+class LiveCards(object):
+    """
+    Keeps one message per chat showing its gryphon, edited as things happen instead of sending a message each time.
+    Changes are debounced: a chat's card is edited at most once per interval, with whatever it should show by then,
+    and not at all if that's what it already shows.
+    """
+
+    def __init__(self, application: GryphonApplication, interval: float):
+        """:param interval: Minimum seconds between edits of a chat's card"""
+        self.application = application
+        self.interval = interval
+        self.pending: dict[int, tuple[str, dict]] = {}  # Text to show and the card's state, by chat
+        self.scheduled: set[int] = set()  # Chats waiting for their next edit, or being edited
+        self.last_edit: dict[int, float] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+        self.edits = 0
+        self.skipped = 0
+
+    def show(self, chat_id: int, chat_data: dict, gryphon: Gryphon, event: str = None) -> None:
+        """
+        Update the chat's card to show the gryphon
+        :param event: What just happened, shown until something else does
+        """
+        card = chat_data.setdefault(CARD_KEY, {})
+        if event is not None:
+            card['event'] = event
+        text = gryphon.card() if card.get('event') is None else f"{gryphon.card()}\n\n{card['event']}"
+        if chat_id not in self.pending and text == card.get('text'):
+            self.skipped += 1
+            return
+        self.pending[chat_id] = (text, card)
+        if chat_id not in self.scheduled:
+            self._schedule(chat_id)
+
+    def _schedule(self, chat_id: int, delay: float = None) -> None:
+        """:param delay: Defaults to the rest of the chat's interval"""
+        self.scheduled.add(chat_id)
+        if delay is None:
+            delay = self.last_edit.get(chat_id, -self.interval) + self.interval - monotonic()
+        asyncio.get_running_loop().call_later(max(0., delay), self._start_edit, chat_id)
+
+    def _start_edit(self, chat_id: int) -> None:
+        task = asyncio.create_task(self._edit(chat_id), name=f'LiveCards:edit:{chat_id}')
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _edit(self, chat_id: int) -> None:
+        text, card = self.pending.pop(chat_id)
+        retry_after = None
+        if text == card.get('text'):  # Changed back before it was shown
+            self.skipped += 1
+        else:
+            retry_after = await self._send(chat_id, text, card)
+
+        if retry_after is not None:
+            self.pending.setdefault(chat_id, (text, card))
+            self._schedule(chat_id, retry_after)
+        elif chat_id in self.pending:  # Changed again while being edited
+            self._schedule(chat_id)
+        else:
+            self.scheduled.discard(chat_id)
+            self._forget_quiet_chats()
+
+    async def _send(self, chat_id: int, text: str, card: dict) -> float | None:
+        """:return: Seconds to wait before trying again, if the card has to be sent again"""
+        while delay := self.application.outbox.global_bucket.take():
+            await asyncio.sleep(delay)
+        self.last_edit[chat_id] = monotonic()
+        bot = self.application.bot
+        try:
+            if card.get('message_id') is None:
+                message = await bot.send_message(chat_id=chat_id, text=text)
+                card['message_id'] = message.message_id
+            else:
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=card['message_id'])
+        except RetryAfter as e:
+            logger.warning("Flood limit hit updating the card in %d, retrying in %s seconds", chat_id, e.retry_after)
+            return e.retry_after
+        except BadRequest as e:
+            if card.get('message_id') is None:
+                logger.warning("Could not send a card to %d: %s", chat_id, e)
+                return None
+            if 'not modified' not in e.message.lower():
+                # Deleted, or too old to edit, so send a new card
+                logger.info("Could not edit the card in %d, sending a new one: %s", chat_id, e.message)
+                card.pop('message_id')
+                return self.interval
+        except TelegramError as e:
+            logger.warning("Could not update the card in %d: %s", chat_id, e)
+            return None
+        self.edits += 1
+        card['text'] = text
+        # Only while the card is still in the chat's data. Marking a hibernated chat would have an empty chat_data
+        # created for it and saved over the stored one.
+        chat_data = self.application.chat_data.get(chat_id)
+        if chat_data is not None and chat_data.get(CARD_KEY) is card:
+            self.application.mark_data_for_update_persistence(chat_ids=chat_id)
+        return None
+
+    def _forget_quiet_chats(self) -> None:
+        if len(self.last_edit) > 2 * len(self.scheduled) + 1000:
+            deadline = monotonic() - self.interval
+            self.last_edit = {chat_id: edited for chat_id, edited in self.last_edit.items() if edited > deadline}
+
+    async def stop(self) -> None:
+        """Wait for edits that are being sent. Edits still waiting for their chat's interval are dropped."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.pending:
+            logger.warning("Stopping with card updates pending for %d chats", len(self.pending))
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import logging
+from time import monotonic
+from typing import Optional
+
+from telegram import Update
+from telegram.ext import BaseHandler, ContextTypes, ConversationHandler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONVERSATION_TIMEOUT = 300.
+DEFAULT_MAX_CONVERSATIONS_PER_CHAT = 10
+
+ConversationKey = tuple[int, ...]
+
+
+class ExpiringConversationHandler(ConversationHandler):
+    """
+    ConversationHandler whose conversations end after a while without updates, and of which each chat can only have
+    a limited number at once. Unlike conversation_timeout, which schedules a job per conversation, expired
+    conversations are ended in bulk by calling expire() now and then. Conversations must be per chat.
+    """
+
+    def __init__(self, *args, expire_after: float = DEFAULT_CONVERSATION_TIMEOUT,
+                 max_per_chat: int = DEFAULT_MAX_CONVERSATIONS_PER_CHAT, **kwargs):
+        """
+        :param expire_after: Seconds without updates after which a conversation ends
+        :param max_per_chat: Starting a conversation beyond this many in a chat ends the chat's least recent one
+        """
+        super().__init__(*args, **kwargs)
+        self.expire_after = expire_after
+        self.max_per_chat = max_per_chat
+        # When each conversation was last updated, least recent first
+        self._updated: dict[ConversationKey, float] = {}
+        # Conversations by chat, least recent first
+        self._by_chat: dict[int, dict[ConversationKey, None]] = {}
+
+    def _update_state(self, new_state: object, key: ConversationKey, handler: Optional[BaseHandler] = None) -> None:
+        super()._update_state(new_state, key, handler)
+        self._forget(key)
+        if key not in self._conversations:
+            return
+
+        self._updated[key] = monotonic()
+        chat = self._by_chat.setdefault(key[0], {})
+        chat[key] = None
+        if len(chat) > self.max_per_chat:
+            self._end(next(iter(chat)))
+
+    def _forget(self, key: ConversationKey) -> None:
+        self._updated.pop(key, None)
+        chat = self._by_chat.get(key[0])
+        if chat is not None:
+            chat.pop(key, None)
+            if not chat:
+                del self._by_chat[key[0]]
+
+    def _end(self, key: ConversationKey) -> None:
+        # Removing the key from the conversations also removes it from persistence, if the handler is persistent
+        super()._update_state(self.END, key)
+        self._forget(key)
+
+    def expire(self) -> int:
+        """
+        End conversations that have had no updates for expire_after seconds
+        :return: Number of conversations ended
+        """
+        deadline = monotonic() - self.expire_after
+        expired = []
+        for key, updated in self._updated.items():
+            if updated > deadline:
+                break
+            expired.append(key)
+        for key in expired:
+            self._end(key)
+        if expired:
+            logger.debug("Ended %d expired conversations, %d left", len(expired), len(self._updated))
+        return len(expired)
+
+
+async def expire_conversations(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """:param context: With the ExpiringConversationHandler as the job's data"""
+    context.job.data.expire()
+
+
+async def stale_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Answer buttons of menus whose conversation has ended, without looking at the chat's gryphon."""
+    await update.callback_query.answer(text="This menu has expired, use /gryphon to get a new one.")
@@ -1,202 +1,303 @@
-import logging
-from abc import ABC, abstractproperty, abstractmethod
-from random import choice, choices, random
-
-
-class BaseFood(ABC):
-    success_grab_text = ['{gryphon} swooped down and nabbed a {food}', '{gryphon} grabbed a {food}',
-                         '{gryphon} caught a {food}', '{gryphon} hunted a {food}', '{gryphon} snatched a {food}']
-
-    success_eating_text = [' and ate it!', ' and gobbled it up!', ' and ate it in one bite!',
-                           ' and ate it in two bites!', ' and devoured it!', ' and ate it with a side of fries!',
-                           ' and turned it into a sandwich!']
-
-    fail_grab_text = ['{gryphon} swooped down and missed a {food}', '{gryphon} missed a {food}',
-                      '{gryphon} failed to catch a {food}', '{gryphon} failed to hunt a {food}']
-
-    fail_eating_text = [' and it got away!', ' and it escaped!', ' and it ran away!',
-                        ' and fell into an undignified heap!', ' and went hungry!', ', it was too fast!',
-                        ', it was too quick!', ', it was too smart!', ', it was too clever!',
-                        ', tripping over its shoelaces!', ', falling for a Nigerian prince scam!', ]
-
-    fail_death_text = [', but became its lunch instead!', ' and fell down a hole and died!', ' and died of shame!',
-                       ' and died of embarrassment!', ' and broke its neck falling down the stairs!',
-                       ' and died of dysentery!', ' and died of scurvy!', ]
+from __future__ import annotations
 
-    def __init__(self, name: str, category: str = 'Small to medium sized mammal',
-                 rarity: float = 0.5, success_rate: float = 0.5, death_chance: float = 0.05):
+import json
+import logging
+import os
+from collections import deque
+from pathlib import Path
+from random import choice, random
+from typing import Callable, NamedTuple, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CATALOG_PATH = Path(__file__).parent / 'data/foods.json'
+DEFAULT_RELOAD_INTERVAL = 10.
+MESSAGE_PARTS = ('success_grab', 'success_eating', 'fail_grab', 'fail_eating', 'fail_death')
+FOOD_FIELDS = ('name', 'category', 'messages', 'rarity', 'success_rate', 'death_chance')
+
+
+class HuntOutcome(NamedTuple):
+    food: Food
+    success: bool
+    died: bool
+    template: str  # Message with a {gryphon} placeholder
+
+    def message(self, gryphon: str) -> str:
+        return self.template.replace('{gryphon}', gryphon)
+
+
+class AliasSampler(object):
+    """Walker's alias method: picks an item with probability proportional to its weight in O(1)."""
+
+    def __init__(self, items: Sequence, weights: Sequence[float]):
+        self.items = list(items)
+        n = len(self.items)
+        total = sum(weights)
+        scaled = [w * n / total for w in weights]
+
+        self.probability = [1.] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            i, j = small.pop(), large.pop()
+            self.probability[i] = scaled[i]
+            self.alias[i] = j
+            scaled[j] -= 1 - scaled[i]
+            (small if scaled[j] < 1 else large).append(j)
+
+    def sample(self):
+        u = random() * len(self.items)
+        i = int(u)
+        return self.items[i] if u - i < self.probability[i] else self.items[self.alias[i]]
+
+
+class Food(object):
+    def __init__(self, name: str, category: str, messages: dict[str, list[str]], rarity: float = 0.5,
+                 success_rate: float = 0.5, death_chance: float = 0.05):
+        """
+        :param messages: Parts of hunt messages by the names in MESSAGE_PARTS. A message is a grab part followed by
+                         an eating or death part, with {gryphon} and {food} placeholders.
+        :param rarity: Weight of the food when picking what a gryphon finds
+        """
         self.name = name
         self.category = category
-        self.rarity: float = rarity  # 0.0 - 1.0
+        self.rarity: float = rarity
         self.success_rate: float = success_rate
         self.death_chance = death_chance
 
+        # A hunt succeeds with success_rate, and a failed hunt is fatal with death_chance. Both are decided by a
+        # single uniform sample, using these thresholds.
+        self.death_threshold = success_rate + (1 - success_rate) * death_chance
+
+        # Every possible message, with the food already filled in
+        self.success_templates = self._templates(messages['success_grab'], messages['success_eating'])
+        self.fail_templates = self._templates(messages['fail_grab'], messages['fail_eating'])
+        self.death_templates = self._templates(messages['fail_grab'], messages['fail_death'])
+
+    def _templates(self, grab_text: list[str], eating_text: list[str]) -> list[str]:
+        return [f"{grab}{eating}".replace('{food}', self.name) for grab in grab_text for eating in eating_text]
+
     def __repr__(self):
         return f"Food({self.name})"
 
+    def outcome(self) -> HuntOutcome:
+        """Decide how a hunt for this food goes."""
+        u = random()
+        if u < self.success_rate:
+            return HuntOutcome(self, True, False, choice(self.success_templates))
+        if u < self.death_threshold:
+            return HuntOutcome(self, False, True, choice(self.death_templates))
+        return HuntOutcome(self, False, False, choice(self.fail_templates))
+
     def hunt(self, name: str) -> tuple[bool, str]:
         """
         Hunt for this food
         :param name: Name of the gryphon
         :return: Tuple of (died, message)
         """
-
-        if random() < self.success_rate:
-            return False, self.hunt_success().format(gryphon=name, food=self.name)
-        else:
-            died, msg = self.hunt_fail()
-            return died, msg.format(gryphon=name, food=self.name)
-
-    def hunt_success(self) -> str:
-        return f"{choice(self.success_grab_text)}{choice(self.success_eating_text)}"
-
-    def hunt_fail(self) -> tuple[bool, str]:
-        if random() < self.death_chance:
-            return True, f"{choice(self.fail_grab_text)}{choice(self.fail_death_text)}"
-        return False, f"{choice(self.fail_grab_text)}{choice(self.fail_eating_text)}"
-
-
-class SmallMammal(BaseFood):
-    def __init__(self, name: str, rarity: float = 0.5, success_rate: float = 0.5, death_chance: float = 0.05):
-        super().__init__(name, category='Small mammal', rarity=rarity, success_rate=success_rate,
-                         death_chance=death_chance)
-
-
-class Bird(BaseFood):
-    fail_death_text = BaseFood.fail_death_text + [' and died of bird flu!', ' and died of avian flu!',
-                                                 ' and got pecked to death!', ' and got chirped to death!',
-                                                 ' and got tweeted to death!', ' and got screeched to death!',
-                                                 ' and got bored to death!']
-
-    def __init__(self, name: str, rarity: float = 0.5, success_rate: float = 0.5, death_chance: float = 0.05):
-        super().__init__(name, category='Birds and Bird Eggs', rarity=rarity, success_rate=success_rate,
-                         death_chance=death_chance)
-
-
-class BirdEgg(BaseFood):
-    success_eating_text = BaseFood.success_eating_text + [' and turned it into an omlette!',
-                                                          ' and turned it into a cake!',
-                                                          ' and turned it into a souffle!',
-                                                          ' and turned it into merengue!', ]
-    fail_grab_text = ['{gryphon} swooped down and missed a {food}', '{gryphon} missed a {food}',
-                      '{gryphon} failed to catch a wiley {food}']
-    fail_eating_text = [', distracted by a shiny object!', ', clearly outmatched in cunning!', ]
-    fail_death_text = [', and slipped on a banana peel and died!', ', and died in a freak juggling accident!']
-
-    def __init__(self, name: str, rarity: float = 0.5, success_rate: float = 0.5, death_chance: float = 0.01):
-        super().__init__(name, category='Birds and Bird Eggs', rarity=rarity, success_rate=success_rate,
-                         death_chance=death_chance)
-
-
-class Fish(BaseFood):
-    success_eating_text = BaseFood.success_eating_text + ['and turned it into sushi!',
-                                                         'and turned it into a fish taco!',
-                                                         'and turned it into a fish sandwich!',
-                                                         'and turned it into a fish burger!', ]
-    fail_eating_text = BaseFood.fail_eating_text + [', it was too slippery!', ', it was too slimy!',
-                                                   ', it was too wet!', ', it was too fishy!', ]
-    fail_death_text = BaseFood.fail_death_text + [', and drowned!', ', and died of hypothermia!',
-                                                 ', and died of ciguaterra poisoning at a sketchy sushi restauraunt!', ]
-
-    def __init__(self, name: str, rarity: float = 0.5, success_rate: float = 0.5, death_chance: float = 0.02):
-        super().__init__(name, category='Fish', rarity=rarity, success_rate=success_rate, death_chance=death_chance)
-
-
-class Livestock(BaseFood):
-    success_eating_text = BaseFood.success_eating_text + [' and turned it into a steak!',
-                                                          ' and turned it into a burger!',
-                                                          ' and turned it into a hot dog!',
-                                                          ' and turned it into a meatloaf!', ]
-
-    fail_death_text = BaseFood.fail_death_text + [', and got trampled to death!', ', and got kicked to death!',
-                                                  ', and got gored to death!', ', and got mauled to death!',
-                                                  ', and got eaten by a nearby dragon!', ]
-
-    def __init__(self, name: str, rarity: float = 0.5, success_rate: float = 0.5, death_chance: float = 0.05):
-        super().__init__(name, category='Livestock', rarity=rarity, success_rate=success_rate,
-                         death_chance=death_chance)
-
-
-class Mythical(BaseFood):
-    success_eating_text = BaseFood.success_eating_text + ['and turned it into a steak!',
-                                                          ' and turned it into a burger!',
-                                                          ' and turned it into a hot dog!',
-                                                          ' and turned it into a meatloaf!', ]
-
-    fail_death_text = BaseFood.fail_death_text + [", and got magick'd™ to death!", ", and got cursed to death!", ]
-
-    def __init__(self, name: str, rarity: float = 0.5, success_rate: float = 0.5, death_chance: float = 0.08):
-        super().__init__(name, category='Mythical Creatures', rarity=rarity, success_rate=success_rate,
-                         death_chance=death_chance)
-
-
-class Dragon(BaseFood):
-    fail_grab_text = ['{gryphon} foolishly attacked a {food}', '{gryphon} had the audacity to attack a {food}',
-                      '{gryphon}, in a moment of madness, attacked a {food}',
-                      '{gryphon}, ignoring all sense of self-preservation, attacked a {food}']
-
-    fail_death_text = [' and got roasted to death!', ' and got burned to death!', ' and got flambéed to death!',
-                       ' and was made into katsu!', ' and was made into a kebab!', ' and was made into a burger!',
-                       ' and was made into stew!', ' and was made into a pie!', ' and was made into a sandwich!',
-                       ' and was cooked to the perfect medium-rare!', ' and was served as a side dish!',
-                       ' and made for a great snack!', ' and made for a delicious entreé!',
-                       ' and made for a tasty appetizer!', ]
-
-    def __init__(self, name: str, rarity: float = 0.1, success_rate: float = 0., death_chance: float = 1, ):
-        super().__init__(name, category='Mythical Creatures', rarity=rarity, success_rate=success_rate,
-                         death_chance=death_chance)
-
-
-class DragonEgg(Dragon):
-    fail_grab_text = ['{gryphon} foolishly attacked a {food}, but ran into mommy',
-                      '{gryphon} had the audacity to attack a {food}, but ran into daddy',
-                      '{gryphon} found a seemingly undefended {food}, but got caught under a box propped up by'
-                      ' a stick',
-                      '{gryphon}, ignoring all sense of self-preservation, attacked a {food}, but got caught in a net']
-
-
-class BabyDragon(DragonEgg):
-    pass
+        outcome = self.outcome()
+        return outcome.died, outcome.message(name)
 
 
 class Foods(object):
-    def __init__(self, foods: list[BaseFood]):
+    """A food catalog, indexed by category with samplers built up front. Not changed once built."""
+
+    def __init__(self, foods: list[Food], categories: Sequence[str] = None):
+        """:param categories: Categories in the order to show them, defaults to the order of foods"""
         self.foods = foods
-        self.categories: dict[str] = {i.category: None for i in self.foods}  # Use dict to maintain order
+        self.categories: dict[str] = dict.fromkeys(categories or [i.category for i in self.foods])  # Ordered
         self.foods_by_category = {i: [j for j in self.foods if j.category == i]
                                   for i in self.categories}
+        self.foods_by_name = {i.name: i for i in self.foods}
+
+        self.sampler = AliasSampler(self.foods, [i.rarity for i in self.foods])
+        self.samplers = {category: AliasSampler(foods, [i.rarity for i in foods])
+                         for category, foods in self.foods_by_category.items()}
 
-    def get_food(self, category: str = None) -> BaseFood:
+    def get_food(self, category: str = None) -> Food:
         if category is None:
-            return choices(self.foods, weights=[i.rarity for i in self.foods], k=1)[0]
-        else:
-            return choices(self.foods_by_category[category],
-                           weights=[i.rarity for i in self.foods_by_category[category]], k=1)[0]
-
-
-foods = Foods(
-    [SmallMammal('rabbit', rarity=0.5, success_rate=0.8),
-     SmallMammal('squirrel', rarity=0.5, success_rate=0.8),
-     SmallMammal('fawn', rarity=0.5, success_rate=0.7),
-     Bird('chicken', rarity=0.7, success_rate=0.8),
-     Bird('duck', rarity=0.5, success_rate=0.8),
-     Bird('cassowary', rarity=0.1, success_rate=0.8, death_chance=0.2),
-     BirdEgg('chicken egg', rarity=0.7, success_rate=0.8),
-     BirdEgg('duck egg', rarity=0.5, success_rate=0.8),
-     BirdEgg('ostrich egg', rarity=0.1, success_rate=0.8, death_chance=0.1),
-     Fish('salmon', rarity=0.5, success_rate=0.6),
-     Fish('tuna', rarity=0.2, success_rate=0.6),
-     Fish('shark', rarity=0.1, success_rate=0.3, death_chance=0.1),
-     Livestock('cow', rarity=0.5, success_rate=0.7),
-     Livestock('pig', rarity=0.7, success_rate=0.8),
-     Livestock('sheep', rarity=0.3, success_rate=0.5),
-     Mythical('unicorn', rarity=0.2, success_rate=0.3, death_chance=0.07),
-     Mythical('phoenix', rarity=0.2, success_rate=0.3, death_chance=0.1),
-     Mythical('hippogriff', rarity=0.2, success_rate=0.3, death_chance=0.1),
-     Mythical('gryphon', rarity=0.1, success_rate=0.3, death_chance=0.2),
-     Dragon('dragon', rarity=0.1),
-     Dragon('young dragon', rarity=0.1, death_chance=0.9),
-     DragonEgg('dragon egg', rarity=0.1),
-     BabyDragon('dragon hatchling', rarity=0.1),
-     ]
-)
+            return self.sampler.sample()
+        return self.samplers[category].sample()
+
+    def hunt(self, category: str = None) -> HuntOutcome:
+        return self.get_food(category).outcome()
+
+    def hunt_many(self, category: str = None, n: int = 1) -> list[HuntOutcome]:
+        """
+        Resolve many hunts at once, picking each food and deciding how its hunt goes in a single loop, the same way
+        as get_food and Food.outcome but without their calls per hunt
+        :param category: Food category to hunt in, or None for any food
+        :param n: Number of hunts
+        """
+        sampler = self.sampler if category is None else self.samplers[category]
+        items, probability, alias, k = sampler.items, sampler.probability, sampler.alias, len(sampler.items)
+        outcomes = []
+        for _ in range(n):
+            u = random() * k
+            i = int(u)
+            food = items[i] if u - i < probability[i] else items[alias[i]]
+            u = random()
+            if u < food.success_rate:
+                templates, success, died = food.success_templates, True, False
+            elif u < food.death_threshold:
+                templates, success, died = food.death_templates, False, True
+            else:
+                templates, success, died = food.fail_templates, False, False
+            outcomes.append(HuntOutcome(food, success, died, templates[int(random() * len(templates))]))
+        return outcomes
+
+
+def _resolve_messages(messages: dict[str, dict], name: str, seen: tuple[str, ...] = ()) -> dict[str, list[str]]:
+    """Messages of the message set called name, following its extends and adds"""
+    if not isinstance(name, str) or name not in messages:
+        raise ValueError(f"Unknown message set {name!r}")
+    if name in seen:
+        raise ValueError(f"Message sets extend each other in a loop: {' -> '.join(seen + (name,))}")
+    spec = messages[name]
+    parts = _resolve_messages(messages, spec['extends'], seen + (name,)) if 'extends' in spec else {}
+    parts = {**parts, **{part: spec[part] for part in MESSAGE_PARTS if part in spec}}
+    add = spec.get('add', {})
+    if not isinstance(add, dict) or not all(isinstance(more, list) for more in add.values()):
+        raise ValueError(f"add of message set {name!r} must map message parts to lists of strings")
+    for part, more in add.items():
+        parts[part] = parts.get(part, []) + more
+    for part, texts in parts.items():
+        if part not in MESSAGE_PARTS:
+            raise ValueError(f"Unknown message part {part!r} in message set {name!r}")
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            raise ValueError(f"{part} of message set {name!r} must be a list of strings")
+    return parts
+
+
+def parse_catalog(data: dict) -> Foods:
+    """
+    Build and validate a catalog from the contents of a catalog file, see data/foods.json. A food's rates and message
+    set default to those of its category, then to Food's defaults.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('messages'), dict) \
+            or not isinstance(data.get('categories'), dict) or not isinstance(data.get('foods'), list):
+        raise ValueError("A catalog needs messages and categories objects and a foods list")
+    messages, categories = data['messages'], data['categories']
+    if not all(isinstance(spec, dict) for spec in [*messages.values(), *categories.values()]):
+        raise ValueError("Message sets and categories must be objects")
+
+    foods = []
+    for entry in data['foods']:
+        if not isinstance(entry, dict) or not entry.get('name') or not isinstance(entry['name'], str):
+            raise ValueError(f"Food without a name: {entry}")
+        name, category = entry['name'], entry.get('category')
+        if unknown := set(entry).difference(FOOD_FIELDS):
+            raise ValueError(f"Unknown fields for {name}: {', '.join(sorted(unknown))}")
+        if not isinstance(category, str) or category not in categories:
+            raise ValueError(f"{name} is in category {category!r}, which isn't listed in categories")
+        if name in (food.name for food in foods):
+            raise ValueError(f"{name} is listed twice")
+        settings = {'messages': 'default', 'rarity': 0.5, 'success_rate': 0.5, 'death_chance': 0.05,
+                    **categories[category], **entry}
+        for rate in ('rarity', 'success_rate', 'death_chance'):
+            if not isinstance(settings[rate], (int, float)) or not 0 <= settings[rate] <= 1:
+                raise ValueError(f"{rate} of {name} must be a number from 0 to 1")
+        parts = _resolve_messages(messages, settings['messages'])
+        if missing := [part for part in MESSAGE_PARTS if not parts.get(part)]:
+            raise ValueError(f"Message set {settings['messages']!r} of {name} has no {', '.join(missing)}")
+        foods.append(Food(name, category, parts, rarity=settings['rarity'], success_rate=settings['success_rate'],
+                          death_chance=settings['death_chance']))
+
+    if not categories:
+        raise ValueError("A catalog needs at least one category")
+    for category in categories:
+        if not any(food.category == category and food.rarity > 0 for food in foods):
+            raise ValueError(f"Category {category!r} has no foods that can be found")
+    return Foods(foods, list(categories))
+
+
+def load_foods(path: Path) -> Foods:
+    with open(path, encoding='utf-8') as f:
+        return parse_catalog(json.load(f))
+
+
+class FoodCatalog(object):
+    """
+    The catalog in use, loaded from a JSON file, which can be reloaded while the bot runs. Reloading builds a new
+    Foods and swaps it in with a single assignment, so each hunt is resolved against one consistent catalog.
+    """
+
+    def __init__(self, path: Path, keep: int = 8):
+        """:param keep: How many replaced catalogs to keep for hunts in categories that have since been removed"""
+        self.path = Path(path)
+        self.current = load_foods(self.path)
+        self._file_stat = self._stat()
+        self._previous: deque[Foods] = deque(maxlen=keep)
+        self._listeners: list[Callable[[Foods], None]] = []
+
+    @property
+    def categories(self) -> dict[str]:
+        return self.current.categories
+
+    def on_reload(self, listener: Callable[[Foods], None]) -> None:
+        """Call listener with the new catalog whenever one is loaded"""
+        self._listeners.append(listener)
+
+    def _stat(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _replace(self, catalog: Foods) -> None:
+        self._previous.appendleft(self.current)
+        self.current = catalog
+        for listener in self._listeners:
+            listener(catalog)
+
+    def load(self, path: Path) -> None:
+        """Switch to another catalog file, raising OSError or ValueError if it can't be loaded"""
+        catalog = load_foods(path)
+        self.path = Path(path)
+        self._file_stat = self._stat()
+        self._replace(catalog)
+
+    def reload(self) -> bool:
+        """
+        Load the catalog file again, keeping the current catalog if the file is invalid
+        :return: Whether a new catalog was loaded
+        """
+        self._file_stat = self._stat()
+        try:
+            catalog = load_foods(self.path)
+        except (OSError, ValueError) as e:
+            logger.error("Keeping the current food catalog, %s could not be loaded: %s", self.path, e)
+            return False
+        self._replace(catalog)
+        logger.info("Loaded %d foods in %d categories from %s", len(catalog.foods), len(catalog.categories),
+                    self.path)
+        return True
+
+    def reload_if_changed(self) -> bool:
+        """Reload the catalog if the file was modified since it was last loaded"""
+        if self._stat() == self._file_stat:
+            return False
+        return self.reload()
+
+    def _catalog_for(self, category: Optional[str]) -> tuple[Foods, Optional[str]]:
+        """:return: Tuple of (catalog, category) to resolve a hunt in category with"""
+        catalog = self.current
+        if category is not None and category not in catalog.samplers:
+            # The hunt started before the category was removed, resolve it against a catalog that still had it
+            catalog = next((previous for previous in self._previous if category in previous.samplers), catalog)
+            if category not in catalog.samplers:  # Not loaded since the bot started, any food will do
+                category = None
+        return catalog, category
+
+    def hunt(self, category: str = None) -> HuntOutcome:
+        catalog, category = self._catalog_for(category)
+        return catalog.hunt(category)
+
+    def hunt_many(self, category: str = None, n: int = 1) -> list[HuntOutcome]:
+        catalog, category = self._catalog_for(category)
+        return catalog.hunt_many(category, n)
+
+
+foods = FoodCatalog(DEFAULT_CATALOG_PATH)
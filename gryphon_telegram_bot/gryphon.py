@@ -2,13 +2,14 @@ from __future__ import annotations
 
 import asyncio
 from collections import deque
+from enum import IntEnum
 from pathlib import Path
 import logging
-from random import choice
+from random import randrange
 from time import time
-from typing import Union
+from typing import NamedTuple, Sequence, TypeVar, Union
 
-from .food import foods
+from .food import Foods, HuntOutcome, foods
 
 
 def load_data(path: Path) -> list[str]:
@@ -17,95 +18,222 @@ def load_data(path: Path) -> list[str]:
     return [i.rstrip() for i in data]
 
 
+T = TypeVar('T')
+
+
+class ShuffleBag(object):
+    """
+    Picks items at random without repeating any of the last `window` picks. Picked items wait in a queue before going
+    back into the bag, so each pick takes constant time however full the window is.
+    """
+    __slots__ = ('bag', 'recent', 'window')
+
+    def __init__(self, size: int, window: int = None):
+        """:param window: Defaults to half the items"""
+        self.window = size // 2 if window is None else window
+        self.bag = list(range(size))
+        self.recent = deque()
+
+    def __len__(self) -> int:
+        return len(self.bag) + len(self.recent)
+
+    def draw(self) -> int:
+        """:return: Index of the picked item"""
+        i = randrange(len(self.bag))
+        item = self.bag[i]
+        self.recent.append(item)
+        if len(self.recent) > self.window:
+            self.bag[i] = self.recent.popleft()
+        else:
+            self.bag[i] = self.bag[-1]
+            self.bag.pop()
+        return item
+
+    def choose(self, items: Sequence[T]) -> T:
+        if len(self) != len(items):  # The data file changed, start over
+            self.__init__(len(items))
+        return items[self.draw()]
+
+
+def format_duration(seconds: float) -> str:
+    """Returns a duration in seconds as a formatted string."""
+    if seconds < 60:
+        return f"{seconds:.0f} seconds"
+    elif seconds < 3600:
+        return f"{seconds / 60:.0f} minutes"
+    elif seconds < 86400:
+        return f"{seconds / 3600:.0f} hours"
+    elif seconds < 604800:
+        return f"{seconds / 86400:.0f} days"
+    elif seconds < 2419200:
+        return f"{seconds / 604800:.0f} weeks"
+    elif seconds < 29030400:
+        return f"{seconds / 2419200:.0f} months"
+    else:
+        return f"{seconds / 29030400:.0f} years"
+
+
+def format_age(age: float) -> str:
+    """Returns an age in seconds as a formatted string."""
+    return f"{format_duration(age)} old"
+
+
+class GryphonRecord(NamedTuple):
+    """What is remembered of a gryphon after it's gone."""
+    name: str
+    birthday: float
+    deathday: float
+    cause_of_death: str
+    feather_colour: str
+
+    @property
+    def age(self) -> str:
+        return format_age(self.deathday - self.birthday)
+
+
+class State(IntEnum):
+    IDLE = 0
+    SLEEPING = 1
+    HUNTING = 2
+    FLYING = 3
+    DEAD = 4
+
+    @property
+    def label(self) -> str:
+        return self.name.lower()
+
+
+class PendingAction(IntEnum):
+    """What to do when the gryphon's current event is done."""
+    NONE = 0
+    HUNT = 1
+
+
 class Gryphon(object):
+    # Bump when changing __slots__, and handle the previous version in __setstate__
+    SCHEMA_VERSION = 2
+    __slots__ = ('name', 'feather_colour', 'birthday', 'deathday', 'cause_of_death', 'state',
+                 'event_done_time', 'pending_action', 'pending_parameter', 'riddle_bag', 'last_hunt')
+
     riddles = load_data(Path(__file__).parent / 'data/riddles.txt')
-    states = ["sleeping", "hunting", "flying", "idle", "dead"]
     commands = {'screech': ('Screech', None),
                 'nap': ('Nap', None),
                 'fly': ('Fly', None),
                 'hunt': ('Hunt', {i: i for i in foods.categories}),
                 'tell_riddle': ('Riddle', None),
                 'status': ('Status', None),
+                'stats': ('Stats', None),  # Answered by the bot from its stats, rather than by the gryphon
                 'change_feather_colour': ("Change Feather Colour",
                                           {'🟥': 'red', '🟧': 'orange', '🟨': 'yellow',
                                            '🟩': 'green', '🟦': 'blue', '🟪': 'violet',
                                            '🟫': 'brown', '⬛': 'red', '⬜': 'white'}),
                 }
     names = load_data(Path(__file__).parent / 'data/names.txt')
-    last_names = deque(maxlen=len(names) // 2)
 
-    def __init__(self):
-        self.last_riddles = deque(maxlen=len(self.riddles) // 2)
+    def __init__(self, names: ShuffleBag = None, riddles: ShuffleBag = None):
+        """
+        :param names: The chat's bag of names, so the chat doesn't see the same names again soon
+        :param riddles: The chat's bag of riddles, usually taken over from the previous gryphon
+        """
+        self.riddle_bag = riddles if riddles is not None else ShuffleBag(len(self.riddles))
         self.feather_colour = "white"
-
-        while True:
-            self.name = choice(self.names)
-            if self.name not in self.last_names:
-                break
-        self.last_names.append(self.name)
+        self.name = (names if names is not None else ShuffleBag(len(self.names))).choose(self.names)
 
         self.birthday = time()
         self.deathday: Union[None, float] = None
+        self.cause_of_death: Union[None, str] = None
 
         self.event_done_time: Union[None, float] = None
-        self.event_done_callback: Union[None, callable] = None
-        self.event_done_callback_args: Union[None, tuple] = None
+        self.pending_action = PendingAction.NONE
+        self.pending_parameter: Union[None, str] = None
+        self.last_hunt: Union[None, HuntOutcome] = None  # Set when an event finishes with a hunt, not persisted
+
+        self.state = State.IDLE
+
+    def __getstate__(self) -> tuple:
+        return (self.SCHEMA_VERSION, self.name, self.feather_colour, self.birthday, self.deathday,
+                self.cause_of_death, int(self.state), self.event_done_time, int(self.pending_action),
+                self.pending_parameter, self.riddle_bag)
 
-        self._state = "idle"
+    def __setstate__(self, state: Union[tuple, dict]):
+        if isinstance(state, dict):
+            state = self._upgrade_unversioned(state)
+        if state[0] < 2:
+            state = (*state[:-1], self._riddle_bag_from_last_riddles(state[-1]))
+
+        (_, self.name, self.feather_colour, self.birthday, self.deathday, self.cause_of_death, gryphon_state,
+         self.event_done_time, pending_action, self.pending_parameter, self.riddle_bag) = state
+        self.state = State(gryphon_state)
+        self.pending_action = PendingAction(pending_action)
+        self.last_hunt = None
+
+    @classmethod
+    def _riddle_bag_from_last_riddles(cls, last_riddles: Sequence[str]) -> ShuffleBag:
+        """Keep the riddles a gryphon told recently, as stored before version 2, out of its new riddle bag."""
+        bag = ShuffleBag(len(cls.riddles))
+        for riddle in last_riddles:
+            if riddle in cls.riddles and (index := cls.riddles.index(riddle)) in bag.bag:
+                bag.bag.remove(index)
+                bag.recent.append(index)
+        while len(bag.recent) > bag.window:
+            bag.bag.append(bag.recent.popleft())
+        return bag
+
+    @classmethod
+    def _upgrade_unversioned(cls, state: dict) -> tuple:
+        """Convert the __dict__ of a gryphon pickled before __slots__ were used to the current state tuple."""
+        callback = state.get('event_done_callback')
+        if getattr(callback, '__name__', None) == '_hunt_callback':
+            pending_action = PendingAction.HUNT
+            pending_parameter = (state.get('event_done_callback_args') or (None,))[0]
+        else:
+            pending_action, pending_parameter = PendingAction.NONE, None
+        return (0, state['name'], state['feather_colour'], state['birthday'], state.get('deathday'),
+                state.get('cause_of_death'), State[state['_state'].upper()], state.get('event_done_time'),
+                pending_action, pending_parameter, state.get('last_riddles', ()))
 
     @property
     def age(self) -> str:
         """Returns the age of the gryphon as a formatted string."""
         if self.deathday is not None:
-            age = self.deathday - self.birthday
-        else:
-            age = time() - self.birthday
-
-        if age < 60:
-            return f"{age:.0f} seconds old"
-        elif age < 3600:
-            return f"{age / 60:.0f} minutes old"
-        elif age < 86400:
-            return f"{age / 3600:.0f} hours old"
-        elif age < 604800:
-            return f"{age / 86400:.0f} days old"
-        elif age < 2419200:
-            return f"{age / 604800:.0f} weeks old"
-        elif age < 29030400:
-            return f"{age / 2419200:.0f} months old"
-        else:
-            return f"{age / 29030400:.0f} years old"
-
-    @property
-    def state(self):
-        return self._state
+            return format_age(self.deathday - self.birthday)
+        return format_age(time() - self.birthday)
 
-    @state.setter
-    def state(self, new_state: str):
-        if new_state in self.states:
-            self._state = new_state
-        else:
-            raise ValueError(f"Invalid state {new_state}")
+    def record(self, cause_of_death: str = "Retired") -> GryphonRecord:
+        """
+        Summarize the gryphon for the chat's history.
+        :param cause_of_death: Used if the gryphon is still alive
+        """
+        if self.state == State.DEAD:
+            return GryphonRecord(self.name, self.birthday, self.deathday or self.birthday,
+                                 self.cause_of_death or "Unknown", self.feather_colour)
+        return GryphonRecord(self.name, self.birthday, time(), cause_of_death, self.feather_colour)
 
     def birth(self):
         return f"Screech! I'm {self.name} the gryphon!"
 
     def status(self):
-        if self.state == "dead":
+        if self.state == State.DEAD:
             return f"{self.name} the gryphon is currently dead and possibly a dragon snack."
         return f"Screech! I'm {self.name} the gryphon! My feathers are {self.feather_colour} " + \
-            f"and I'm {self.age}. I am currently {self.state}."
+            f"and I'm {self.age}. I am currently {self.state.label}."
+
+    def card(self) -> str:
+        """Like status, but without the age, so it only changes when something happens to the gryphon"""
+        if self.state == State.DEAD:
+            return f"{self.name} the gryphon is dead."
+        return f"{self.name} the gryphon, with {self.feather_colour} feathers, is {self.state.label}."
 
-    def is_busy(self, requested_state: str = None) -> tuple[bool, str]:
-        if self.state == "dead":
+    def is_busy(self, requested_state: State = None) -> tuple[bool, str]:
+        if self.state == State.DEAD:
             return True, "She's dead, Jim."
         if requested_state == self.state:
             return True, "I'm already doing that!"
-        if self.state == "sleeping":
+        if self.state == State.SLEEPING:
             return True, "Screech! I'm trying to sleep!"
-        if self.state == "hunting":
+        if self.state == State.HUNTING:
             return True, "I'm busy hunting!"
-        if self.state == "flying":
+        if self.state == State.FLYING:
             return True, "I'm busy flying!"
         return False, ""
 
@@ -120,13 +248,13 @@ class Gryphon(object):
         if busy:
             return msg
 
-        self.state = "sleeping"
+        self.state = State.SLEEPING
         self.event_done_time = time() + 60
         return f"{self.name} is now napping."
 
     def change_feather_colour(self, colour: str):
         self.feather_colour = colour
-        if self.state == "dead":
+        if self.state == State.DEAD:
             return f"You spray painted the dead gryphon {colour}!"
         return f"You spray painted the gryphon {colour}!"
 
@@ -135,7 +263,7 @@ class Gryphon(object):
         if busy:
             return msg
 
-        self.state = "flying"
+        self.state = State.FLYING
         self.event_done_time = time() + 30
         return f"{self.name} heads out for a flight."
 
@@ -143,43 +271,61 @@ class Gryphon(object):
         busy, msg = self.is_busy()
         if busy:
             return msg
+        if category not in foods.categories:  # A button from before the food catalog was reloaded
+            return f"There is nothing to hunt in {category} anymore."
 
-        self.state = "hunting"
+        self.state = State.HUNTING
         self.event_done_time = time() + 2
-        self.event_done_callback = self._hunt_callback
-        self.event_done_callback_args = (category,)
+        self.pending_action = PendingAction.HUNT
+        self.pending_parameter = category
         return f"{self.name} is now hunting for {category}!"
 
-    def _hunt_callback(self, category: str):
-        died, msg = foods.get_food(category).hunt(self.name)
-        if died:
-            self.state = "dead"
+    def _hunt_callback(self, category: str, done_time: float, outcome: HuntOutcome = None):
+        """
+        :param done_time: When the hunt finished
+        :param outcome: How the hunt went, if already decided
+        """
+        outcome = self.last_hunt = outcome or foods.hunt(category)
+        msg = outcome.message(self.name)
+        if outcome.died:
+            self.state = State.DEAD
+            self.deathday = done_time
+            self.cause_of_death = msg
         return msg
 
     def tell_riddle(self) -> str:
-        if self.state == "dead":
+        if self.state == State.DEAD:
             return "A dead gryphon tells no tales."
         busy, msg = self.is_busy()
         if busy:
             return msg
-        while True:
-            riddle = choice(self.riddles)
-            if riddle not in self.last_riddles:
-                break
-        self.last_riddles.append(riddle)
-        return riddle
-
-    def update(self) -> tuple[bool, str | None]:
+        return self.riddle_bag.choose(self.riddles)
+
+    def update(self, now: float = None, hunt: HuntOutcome = None) -> tuple[bool, str | None]:
+        """
+        Finish the current event if its time has come. It finishes as of its deadline, however late this is called.
+        :param now: Defaults to the current time
+        :param hunt: Outcome to use if the event is a hunt, e.g. one of many resolved at once with foods.hunt_many
+        """
         if self.event_done_time is not None:
-            if time() > self.event_done_time:
+            if (time() if now is None else now) > self.event_done_time:
+                done_time = self.event_done_time
+                action, parameter = self.pending_action, self.pending_parameter
                 self.event_done_time = None
-                self.state = "idle"
+                self.state = State.IDLE
+                self.pending_action = PendingAction.NONE
+                self.pending_parameter = None
+                self.last_hunt = None
+
                 msg = None
-                if self.event_done_callback is not None:
-                    try:
-                        msg = self.event_done_callback(*self.event_done_callback_args)
-                    except TypeError:
-                        msg = self.event_done_callback()
-                    self.event_done_callback = None
+                if action == PendingAction.HUNT:
+                    msg = self._hunt_callback(parameter, done_time, hunt)
                 return True, msg
         return False, None
+
+
+def _update_hunt_categories(catalog: Foods) -> None:
+    Gryphon.commands['hunt'] = ('Hunt', {i: i for i in catalog.categories})
+
+
+foods.on_reload(_update_hunt_categories)
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import logging
+from time import time
+from typing import TYPE_CHECKING
+
+from telegram.ext import ContextTypes
+
+if TYPE_CHECKING:
+    from .application import GryphonApplication
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SWEEP_INTERVAL = 300.
+
+
+class Hibernation(object):
+    """
+    Evicts chats that have been idle for a while from memory. Their data stays in persistence, which loads it again
+    when the chat's next update or job arrives, so this needs a persistence that loads chats lazily, like
+    SQLitePersistence.
+    """
+
+    def __init__(self, idle_after: float):
+        """:param idle_after: Seconds without updates after which a chat is evicted, with a living gryphon or not"""
+        self.idle_after = idle_after
+        # Last update of every chat in memory, chats loaded without an update count from when they were first seen
+        self.last_activity: dict[int, float] = {}
+        self.hibernated = 0
+
+    def touch(self, chat_id: int) -> None:
+        self.last_activity[chat_id] = time()
+
+    def sweep(self, application: GryphonApplication) -> int:
+        """
+        Evict idle chats. Not a coroutine, so an update for a chat can't arrive between checking and evicting it.
+        :return: Number of chats evicted
+        """
+        now = time()
+        evicted = 0
+        for chat_id in list(application.chat_data):
+            if now - self.last_activity.setdefault(chat_id, now) < self.idle_after:
+                continue
+            if chat_id in application.chat_locks:  # Being handled right now
+                continue
+            if application.cards is not None and chat_id in application.cards.scheduled:  # Card edit on its way
+                continue
+            application.hibernate_chat(chat_id)
+            evicted += 1
+        # Also forgets chats that sent updates no handler used, so were never loaded
+        self.last_activity = {chat_id: last for chat_id, last in self.last_activity.items()
+                              if now - last < self.idle_after}
+
+        self.hibernated += evicted
+        if evicted:
+            logger.info("Hibernated %d idle chats, %d still in memory", evicted, len(application.chat_data))
+        return evicted
+
+
+async def hibernate_idle_chats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.application.hibernation.sweep(context.application)
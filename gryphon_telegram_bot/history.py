@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from typing import Union
+
+from .gryphon import Gryphon, GryphonRecord, ShuffleBag
+
+DEFAULT_HISTORY_LIMIT = 10
+
+
+def _trim(history: list[GryphonRecord], limit: int) -> None:
+    if len(history) > limit:
+        del history[:len(history) - limit]
+
+
+def migrate_chat_data(chat_data: dict, history_limit: int = DEFAULT_HISTORY_LIMIT) -> bool:
+    """
+    Convert chat_data from the old layout, where every gryphon the chat ever had was kept in ``chat_data['gryphons']``,
+    to the current gryphon in ``chat_data['gryphon']`` and records of previous ones in ``chat_data['history']``.
+    :param history_limit: How many previous gryphons to remember
+    :return: True if chat_data was changed
+    """
+    if 'gryphons' not in chat_data:
+        return False
+
+    gryphons = chat_data.pop('gryphons')
+    if gryphons:
+        chat_data['gryphon'] = gryphons[-1]
+        history = chat_data.setdefault('history', [])
+        history.extend(gryphon.record() for gryphon in gryphons[:-1])
+        _trim(history, history_limit)
+    return True
+
+
+def get_gryphon(chat_data: dict, history_limit: int = DEFAULT_HISTORY_LIMIT) -> Union[Gryphon, None]:
+    """
+    Returns the chat's current gryphon, if it has one.
+    :param history_limit: How many previous gryphons to remember if chat_data has to be migrated
+    """
+    migrate_chat_data(chat_data, history_limit)
+    return chat_data.get('gryphon')
+
+
+def peek_gryphon(chat_data: dict) -> Union[Gryphon, None]:
+    """Returns the chat's current gryphon, if it has one, leaving chat_data in the old layout if it's in it."""
+    gryphons = chat_data.get('gryphons')
+    return gryphons[-1] if gryphons else chat_data.get('gryphon')
+
+
+def get_name_bag(chat_data: dict) -> ShuffleBag:
+    """Returns the bag the chat's gryphons get their names from, so the chat doesn't see the same names again soon."""
+    bag = chat_data.get('name_bag')
+    if bag is None:
+        bag = chat_data['name_bag'] = ShuffleBag(len(Gryphon.names))
+    return bag
+
+
+def replace_gryphon(chat_data: dict, gryphon: Gryphon, history_limit: int = DEFAULT_HISTORY_LIMIT) -> \
+        Union[GryphonRecord, None]:
+    """
+    Set the chat's current gryphon, moving the previous one into the chat's history.
+    :param history_limit: How many previous gryphons to remember
+    :return: The record of the previous gryphon, if there was one
+    """
+    previous = get_gryphon(chat_data, history_limit)
+    chat_data['gryphon'] = gryphon
+    if previous is None:
+        return None
+
+    record = previous.record()
+    history = chat_data.setdefault('history', [])
+    history.append(record)
+    _trim(history, history_limit)
+    return record
@@ -0,0 +1,203 @@
+"""
+Append-only journal of what happens to gryphons, as JSON lines in segment files that are rotated by size.
+Also a command to replay or aggregate a journal, streaming it one event at a time.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from collections import Counter
+from enum import Enum
+from pathlib import Path
+from time import time
+from typing import IO, Iterator, Optional, Union, TYPE_CHECKING
+
+import typer
+from typing_extensions import Annotated
+
+if TYPE_CHECKING:
+    from .food import HuntOutcome
+    from .gryphon import Gryphon, GryphonRecord
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_GLOB = 'events-*.jsonl'
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+
+
+class Journal(object):
+    """Records nothing. Used when the journal is disabled, so callers don't need to check."""
+
+    def record(self, event: str, chat_id: int, gryphon: Union[Gryphon, GryphonRecord], at: float = None,
+               **fields) -> None:
+        """
+        Record an event
+        :param event: birth, hunt or death
+        :param at: When it happened, defaults to now
+        :param fields: Details of the event, must be JSON serializable
+        """
+
+    def hunt(self, chat_id: int, gryphon: Gryphon, outcome: HuntOutcome, at: float = None) -> None:
+        self.record('hunt', chat_id, gryphon, at, food=outcome.food.name, category=outcome.food.category,
+                    outcome='died' if outcome.died else 'caught' if outcome.success else 'missed')
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class JsonlJournal(Journal):
+    """
+    Buffers events in memory and writes them from a background task, serializing and writing in a thread so neither
+    happens on the event loop. Segments are named by sequence number and a new one is started once the current one
+    is larger than segment_bytes.
+    """
+
+    def __init__(self, directory: Path, segment_bytes: int = DEFAULT_SEGMENT_BYTES, flush_interval: float = 1.,
+                 flush_size: int = 1000):
+        """
+        :param flush_interval: Seconds between writes
+        :param flush_size: Write as soon as this many events are buffered
+        """
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+
+        self.buffer: list[dict] = []
+        self.written = 0
+        self._file: Optional[IO] = None
+        self._segment = 0
+        self._wake: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def record(self, event: str, chat_id: int, gryphon: Union[Gryphon, GryphonRecord], at: float = None,
+               **fields) -> None:
+        self.buffer.append({'t': time() if at is None else at, 'event': event, 'chat': chat_id,
+                            'gryphon': gryphon.name, 'born': gryphon.birthday, **fields})
+        if len(self.buffer) >= self.flush_size and self._wake is not None:
+            self._wake.set()
+
+    def _open_segment(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.directory / f'events-{self._segment:06d}.jsonl', 'a', encoding='utf-8')
+
+    def _write(self, events: list[dict]) -> None:
+        """Runs in a thread"""
+        if self._file is None or self._file.tell() >= self.segment_bytes:
+            if self._file is not None:
+                self._segment += 1
+            self._open_segment()
+        self._file.write(''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in events))
+        self._file.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            events, self.buffer = self.buffer, []
+            if events:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, events)
+                self.written += len(events)
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except OSError:
+                logger.exception("Could not write to the journal in %s", self.directory)
+
+    async def start(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        segments = sorted(self.directory.glob(SEGMENT_GLOB))
+        self._segment = int(segments[-1].stem.split('-')[1]) if segments else 0
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run(), name='Journal:writer')
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            # Let the writer finish rather than cancelling it, so a write isn't left running in its thread
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def iter_events(directory: Path, chat_id: int = None, gryphon: str = None, food: str = None) -> Iterator[dict]:
+    """
+    Read the events in a journal in the order they were written, one at a time, optionally only those matching the
+    given chat, gryphon name or food. The journals of all shards are read if directory holds several.
+    """
+    for segment in sorted(Path(directory).rglob(SEGMENT_GLOB)):
+        with open(segment, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:  # Cut off by a crash while it was being written
+                    logger.warning("Skipping unreadable event in %s: %r", segment, line)
+                    continue
+                if chat_id is not None and event['chat'] != chat_id:
+                    continue
+                if gryphon is not None and event['gryphon'] != gryphon:
+                    continue
+                if food is not None and event.get('food') != food:
+                    continue
+                yield event
+
+
+class GroupBy(str, Enum):
+    chat = 'chat'
+    gryphon = 'gryphon'
+    food = 'food'
+
+
+def aggregate(events: Iterator[dict], by: GroupBy) -> dict[str, Counter]:
+    """Count events of each kind, and hunt outcomes, per chat, gryphon or food."""
+    groups: dict[str, Counter] = {}
+    for event in events:
+        if by == GroupBy.food:
+            if 'food' not in event:
+                continue
+            key = event['food']
+        elif by == GroupBy.gryphon:
+            key = f"{event['chat']}/{event['gryphon']}/{event['born']:.0f}"
+        else:
+            key = str(event['chat'])
+        counts = groups.setdefault(key, Counter())
+        counts[event['event']] += 1
+        if 'outcome' in event:
+            counts[event['outcome']] += 1
+    return groups
+
+
+def journal(directory: Annotated[Path, typer.Argument(help='Journal directory')],
+            by: Annotated[GroupBy, typer.Option(help='Count events per chat, gryphon or food')] = None,
+            chat: Annotated[int, typer.Option(help='Only events in this chat')] = None,
+            gryphon: Annotated[str, typer.Option(help='Only events of gryphons with this name')] = None,
+            food: Annotated[str, typer.Option(help='Only hunts for this food')] = None) -> None:
+    """Print the events in a journal as JSON lines, or with --by, counts of them as JSON."""
+    events = iter_events(directory, chat_id=chat, gryphon=gryphon, food=food)
+    if by is None:
+        for event in events:
+            typer.echo(json.dumps(event))
+    else:
+        typer.echo(json.dumps(aggregate(events, by), indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(journal)
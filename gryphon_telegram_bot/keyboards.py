@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+from typing import NamedTuple, Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from .food import foods
+from .gryphon import Gryphon
+
+# Callback data is the button's index in hex, padded to this many digits. Telegram allows up to 64 bytes.
+CALLBACK_DATA_WIDTH = 3
+
+
+class Callback(NamedTuple):
+    """What pressing a button does: the name of the handler to run, and the gryphon command and parameter if any"""
+    handler: str
+    action: Optional[str] = None
+    parameter: Optional[str] = None
+
+
+class Keyboards(object):
+    """
+    The bot's inline keyboards, built up front, with compact callback data that maps back to each button's Callback.
+    Rebuilding them keeps the callback data of buttons that are still there, and keeps decoding buttons that are gone,
+    so menus sent before still work.
+    """
+
+    def __init__(self, commands: dict[str, tuple[str, Optional[dict[str, str]]]]):
+        """:param commands: Gryphon commands in the format of Gryphon.commands"""
+        self.callbacks: dict[str, Callback] = {}
+        self._data: dict[Callback, str] = {}  # The reverse of callbacks
+        self.build(commands)
+
+    def build(self, commands: dict[str, tuple[str, Optional[dict[str, str]]]]) -> None:
+        self.new_gryphon = InlineKeyboardMarkup([[self._button("Summon a new gryphon!", Callback('new_gryphon'))]])
+        self.actions = InlineKeyboardMarkup([[self._button(label, Callback('gryphon_action', command))]
+                                             for command, (label, _) in commands.items()])
+        self.parameters = {
+            command: InlineKeyboardMarkup(self._layout([
+                self._button(label, Callback('gryphon_action_parameter', command, parameter))
+                for label, parameter in parameters.items()]))
+            for command, (_, parameters) in commands.items() if parameters}
+
+    def _button(self, label: str, callback: Callback) -> InlineKeyboardButton:
+        data = self._data.get(callback)
+        if data is None:
+            data = self._data[callback] = f'{len(self.callbacks):0{CALLBACK_DATA_WIDTH}x}'
+            self.callbacks[data] = callback
+        return InlineKeyboardButton(label, callback_data=data)
+
+    @staticmethod
+    def _layout(buttons: list[InlineKeyboardButton]) -> list[list[InlineKeyboardButton]]:
+        """Put several buttons with short labels on each row"""
+        max_len = max(len(button.text) for button in buttons)
+        n = 3 if max_len < 5 else 2 if max_len < 10 else 1
+        return [buttons[i:i + n] for i in range(0, len(buttons), n)]
+
+    def decode(self, data: object) -> Callback | None:
+        """:return: The Callback of the button with this callback data, or None if it isn't one of ours"""
+        return self.callbacks.get(data) if isinstance(data, str) else None
+
+
+keyboards = Keyboards(Gryphon.commands)
+foods.on_reload(lambda catalog: keyboards.build(Gryphon.commands))
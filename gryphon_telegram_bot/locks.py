@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+from typing import Callable
+from weakref import WeakValueDictionary
+
+
+class ChatLocks(object):
+    """One asyncio lock per chat, forgotten again once nothing holds or waits for it."""
+
+    def __init__(self):
+        self._locks: WeakValueDictionary[int, asyncio.Lock] = WeakValueDictionary()
+
+    def __call__(self, chat_id: int) -> asyncio.Lock:
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        return lock
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def __contains__(self, chat_id: int) -> bool:
+        """Whether an update or job for the chat is being processed or waiting to be"""
+        return chat_id in self._locks
+
+
+def chat_locked(callback: Callable) -> Callable:
+    """
+    Run a job callback while holding its chat's lock, so it doesn't change a gryphon while an update for the same chat
+    is being processed. Updates take the lock themselves, in GryphonApplication.process_update.
+    """
+    @functools.wraps(callback)
+    async def wrapper(context):
+        async with context.application.chat_locks(context.job.chat_id):
+            return await callback(context)
+    return wrapper
@@ -1,21 +1,42 @@
 from __future__ import annotations
 
+import asyncio
+import ipaddress
 import logging
+import signal
+from collections import Counter
+from enum import Enum
 from pathlib import Path
-from typing import Union, Mapping
+from time import perf_counter, time
+from typing import Callable, Union, Mapping
 
 import typer
 from typing_extensions import Annotated
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import Update
 from telegram.ext import (
     Application,
+    BasePersistence,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
-    ConversationHandler, PicklePersistence,
+    ConversationHandler, JobQueue, PersistenceInput, PicklePersistence,
 )
-
-from .gryphon import Gryphon
+from telegram.request import BaseRequest
+
+from .application import DEFAULT_WARMUP, GryphonApplication
+from .conversations import (DEFAULT_CONVERSATION_TIMEOUT, DEFAULT_MAX_CONVERSATIONS_PER_CHAT,
+                            ExpiringConversationHandler, expire_conversations, stale_menu)
+from .food import DEFAULT_RELOAD_INTERVAL, foods
+from .gryphon import Gryphon, PendingAction, State, format_duration
+from .hibernation import DEFAULT_SWEEP_INTERVAL, hibernate_idle_chats
+from .history import (DEFAULT_HISTORY_LIMIT, get_gryphon, get_name_bag, migrate_chat_data, peek_gryphon,
+                      replace_gryphon)
+from .keyboards import keyboards
+from .locks import chat_locked
+from .outbox import DEFAULT_CHAT_RATE, DEFAULT_GLOBAL_RATE
+from .persistence import SQLitePersistence
+from .profiling import DEFAULT_SNAPSHOT_INTERVAL
+from .stats import SHARD_STATS_INTERVAL, format_stats, get_global_stats, record_birth, record_hunt
 
 # Enable logging
 logging.basicConfig(
@@ -24,6 +45,7 @@ logging.basicConfig(
 # set higher logging level for httpx to avoid all GET and POST requests being logged
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("apscheduler.executors.default").setLevel(logging.WARNING)
+logging.getLogger("apscheduler.scheduler").setLevel(logging.WARNING)
 
 
 logger = logging.getLogger(__name__)
@@ -31,27 +53,60 @@ logger = logging.getLogger(__name__)
 
 async def get_last_gryphon(context: ContextTypes.DEFAULT_TYPE) -> Union[Gryphon, None]:
     """Setup gryphon"""
-    try:
-        return context.chat_data["gryphons"][-1]
-    except KeyError:
-        return None
+    return get_gryphon(context.chat_data, context.application.history_limit)
+
+
+def schedule_gryphon_update(job_queue: JobQueue, chat_id: int, gryphon: Gryphon) -> None:
+    """Schedule a one-shot job for when the gryphon's current event is done."""
+    if gryphon.event_done_time is None:
+        return
+    job_queue.run_once(update_gryphon, when=max(0., gryphon.event_done_time - time()), chat_id=chat_id,
+                       name=f'update_gryphon_{chat_id}')
+
+
+def run_gryphon_action(context: ContextTypes.DEFAULT_TYPE, chat_id: int, gryphon: Gryphon,
+                       action: str, *args) -> str:
+    """Run a gryphon command, scheduling an update if it started a new event."""
+    event_done_time = gryphon.event_done_time
+    msg = getattr(gryphon, action)(*args)
+    if gryphon.event_done_time != event_done_time:
+        schedule_gryphon_update(context.job_queue, chat_id, gryphon)
+    notify(context.application, chat_id, context.chat_data, gryphon)
+    return msg
+
+
+def notify(application: GryphonApplication, chat_id: int, chat_data: dict, gryphon: Gryphon,
+           msg: str = None) -> None:
+    """
+    Tell the chat what happened to its gryphon: on the chat's live card if enabled, which is updated even without a
+    message, otherwise in a new message
+    """
+    if application.cards is not None:
+        application.cards.show(chat_id, chat_data, gryphon, msg)
+    elif msg:
+        application.outbox.send(chat_id, msg)
 
 
 async def new_gryphon(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
 
-    previous_gryphon = await get_last_gryphon(context)
-    if not previous_gryphon:
-        context.chat_data["gryphons"] = [Gryphon()]
-    else:
-        context.chat_data["gryphons"].append(Gryphon())
-    gryphon = await get_last_gryphon(context)
+    previous = get_gryphon(context.chat_data, context.application.history_limit)
+    if previous is not None and previous.state != State.DEAD:
+        # Already summoned since the menu was sent, by a second tap or from someone else's menu
+        await query.answer(text=f"{previous.name} is still alive.")
+        return ConversationHandler.END
+    gryphon = Gryphon(names=get_name_bag(context.chat_data),
+                      riddles=previous.riddle_bag if previous is not None else None)
+    previous_gryphon = replace_gryphon(context.chat_data, gryphon, history_limit=context.application.history_limit)
+    context.application.metrics.birth()
+    record_birth(context.chat_data, context.bot_data, update.effective_chat.id, gryphon, previous_gryphon)
+    context.application.journal.record('birth', update.effective_chat.id, gryphon)
 
     await query.answer(text="Summoning a new gryphon...")
 
-    if previous_gryphon:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Farewell, {previous_gryphon.name}.")
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=gryphon.birth())
+    if previous_gryphon and context.application.cards is None:
+        context.application.outbox.send(update.effective_chat.id, f"Farewell, {previous_gryphon.name}.")
+    notify(context.application, update.effective_chat.id, context.chat_data, gryphon, gryphon.birth())
 
     return ConversationHandler.END
 
@@ -61,20 +116,17 @@ async def gryphon(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
 
     if not gryphon:
         msg = "There is no gryphon in this chat yet."
-        keyboard = [[InlineKeyboardButton("Summon a new gryphon!", callback_data='new_gryphon')]]
+        reply_markup = keyboards.new_gryphon
         next_state = 'new_gryphon'
-    elif gryphon.state == "dead":
+    elif gryphon.state == State.DEAD:
         msg = f"Your gryphon {gryphon.name} is dead."
-        keyboard = [[InlineKeyboardButton("Summon a new gryphon!", callback_data='new_gryphon')]]
+        reply_markup = keyboards.new_gryphon
         next_state = 'new_gryphon'
     else:
         msg = f"Your gryphon is called {gryphon.name}."
-        keyboard = [[InlineKeyboardButton(data[0], callback_data=f'gryphon_action.{command}')]
-                    for command, data in gryphon.commands.items()]
-
+        reply_markup = keyboards.actions
         next_state = 'gryphon_action'
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(msg, reply_markup=reply_markup)
 
     return next_state
@@ -83,30 +135,24 @@ async def gryphon(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
 async def gryphon_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int | str:
     query = update.callback_query
     gryphon = await get_last_gryphon(context)
-    _, _, action = query.data.partition('.')
+    action = keyboards.decode(query.data).action
+    if gryphon is None:
+        await query.answer(text="There is no gryphon in this chat yet.")
+        return ConversationHandler.END
 
     if action in gryphon.commands.keys():
-        if not gryphon.commands[action][1]:
+        if action == 'stats':
             await query.answer()
-            await query.edit_message_text(text=getattr(gryphon, action)())
+            await query.edit_message_text(text=format_stats(context.chat_data, context.application.global_stats()))
+            return ConversationHandler.END
+        elif action not in keyboards.parameters:
+            await query.answer()
+            await query.edit_message_text(
+                text=run_gryphon_action(context, update.effective_chat.id, gryphon, action))
             return ConversationHandler.END
         else:
             await query.answer()
-
-            buttons = {label: InlineKeyboardButton(label, callback_data=f'gryphon_action.{action}-{parameter}')
-                       for label, parameter in gryphon.commands[action][1].items()}
-
-            max_len = max(len(label) for label in buttons.keys())
-            if max_len < 5:
-                n = 3
-                keyboard = [list(buttons.values())[i:i + n] for i in range(0, len(buttons), n)]
-            elif max_len < 10:
-                n = 2
-                keyboard = [list(buttons.values())[i:i + n] for i in range(0, len(buttons), n)]
-            else:
-                keyboard = [[button] for button in buttons.values()]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(text=f"Select a parameter:", reply_markup=reply_markup)
+            await query.edit_message_text(text=f"Select a parameter:", reply_markup=keyboards.parameters[action])
             return 'gryphon_action'
     return ConversationHandler.END
 
@@ -114,61 +160,365 @@ async def gryphon_action(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def gryphon_action_parameter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     gryphon = await get_last_gryphon(context)
-    _, _, action = query.data.partition('.')
-    action, _, parameter = action.partition('-')
+    _, action, parameter = keyboards.decode(query.data)
+    if gryphon is None:
+        await query.answer(text="There is no gryphon in this chat yet.")
+        return ConversationHandler.END
 
     if action in gryphon.commands.keys():
         await query.answer()
-        await query.edit_message_text(text=getattr(gryphon, action)(parameter))
+        await query.edit_message_text(
+            text=run_gryphon_action(context, update.effective_chat.id, gryphon, action, parameter))
         return ConversationHandler.END
     return ConversationHandler.END
 
 
-async def update_gryphon(context: ContextTypes.DEFAULT_TYPE):
-    for chat in context.job.data:
-        try:
-            gryphon = context.job.data[chat]['gryphons'][-1]
-            if gryphon:
-                event, msg = gryphon.update()
-                if event:
-                    await context.bot.send_message(chat_id=chat, text=msg)
-        except KeyError:
-            pass
+def record_event(application: GryphonApplication, chat_id: int, gryphon: Gryphon, done_time: float = None) -> None:
+    """
+    Count the outcome of the event the gryphon just finished in metrics, and add it to the journal
+    :param done_time: When the event finished, defaults to now
+    """
+    if gryphon.last_hunt is not None:
+        record_hunt(application.chat_data[chat_id], application.bot_data, chat_id, gryphon, gryphon.last_hunt)
+        application.metrics.hunt(gryphon.last_hunt)
+        application.journal.hunt(chat_id, gryphon, gryphon.last_hunt, at=done_time)
+        if gryphon.last_hunt.died:
+            application.metrics.death()
+            application.journal.record('death', chat_id, gryphon, at=gryphon.deathday, cause=gryphon.cause_of_death)
 
 
-states = {'new_gryphon': [CallbackQueryHandler(new_gryphon, pattern=r"^new_gryphon$")],
-          'gryphon_action': [CallbackQueryHandler(gryphon_action, pattern=r"^gryphon_action\.([^-]+)$"),
-                             CallbackQueryHandler(gryphon_action_parameter,
-                                                  pattern=r"^gryphon_action\.([^-]+)-([^-]+)$")],
-          }
+async def gryphon_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(format_stats(context.chat_data, context.application.global_stats()))
 
 
-def main(token: Annotated[str, typer.Argument(help='Telegram bot token')],
-         persistence_path: Annotated[Path, typer.Argument(help='Where to save persistence files')]) -> None:
-    """Run the bot."""
+@chat_locked
+async def update_gryphon(context: ContextTypes.DEFAULT_TYPE):
+    """Finish the event of the gryphon in the job's chat once its deadline has passed."""
+    start = perf_counter()
+    gryphon = await get_last_gryphon(context)
+    if not gryphon:
+        return
 
-    persistence_path.mkdir(parents=True, exist_ok=True)  # create persistence_path if it doesn't exist
+    action = gryphon.state.name.lower()
+    event, msg = gryphon.update()
+    if event:
+        record_event(context.application, context.job.chat_id, gryphon)
+        notify(context.application, context.job.chat_id, context.chat_data, gryphon, msg)
+    else:
+        # Woken up early, or the event was replaced in the meantime
+        schedule_gryphon_update(context.job_queue, context.job.chat_id, gryphon)
+    seconds = perf_counter() - start
+    context.application.metrics.observe_update(seconds)
+    context.application.profiler.observe('update_gryphon', seconds, context.job.chat_id, action)
+
+
+def has_pending_event(chat_data: dict) -> bool:
+    """Whether the chat's gryphon is in the middle of an event, so the chat has to be loaded at startup."""
+    # Without migrating, which needs the bot's history limit and happens once the chat is loaded
+    gryphon = peek_gryphon(chat_data)
+    return gryphon is not None and gryphon.event_done_time is not None
+
+
+async def schedule_pending_updates(application: GryphonApplication) -> None:
+    """Reschedule updates for gryphons that were busy when the bot was last stopped."""
+    for chat_id, chat_data in application.chat_data.items():
+        gryphon = get_gryphon(chat_data, application.history_limit)
+        if gryphon is not None:
+            schedule_gryphon_update(application.job_queue, chat_id, gryphon)
+
+
+async def catch_up_overdue_events(application: GryphonApplication) -> None:
+    """
+    Finish the events of gryphons whose deadline passed while the bot was stopped, all at once. Their notifications
+    are spread over the application's warm-up window instead of being sent in one burst.
+    """
+    now = time()
+    overdue = []
+    for chat_id, chat_data in application.chat_data.items():
+        gryphon = get_gryphon(chat_data, application.history_limit)
+        if gryphon is not None and gryphon.event_done_time is not None and gryphon.event_done_time <= now:
+            overdue.append((chat_id, chat_data, gryphon))
+    # Hunts are resolved in one batch per category
+    hunts = Counter(gryphon.pending_parameter for _, _, gryphon in overdue
+                    if gryphon.pending_action == PendingAction.HUNT)
+    outcomes = {category: iter(foods.hunt_many(category, n)) for category, n in hunts.items()}
+
+    notifications = []
+    for chat_id, chat_data, gryphon in overdue:
+        done_time = gryphon.event_done_time
+        hunt = next(outcomes[gryphon.pending_parameter]) if gryphon.pending_action == PendingAction.HUNT else None
+        _, msg = gryphon.update(now, hunt)
+        record_event(application, chat_id, gryphon, done_time)
+        application.mark_data_for_update_persistence(chat_ids=chat_id)
+        if msg or application.cards is not None:
+            msg = msg and f"{msg} ({format_duration(now - done_time)} ago)"
+            notifications.append((chat_id, chat_data, gryphon, msg))
+
+    if not notifications:
+        return
+    logger.info("Caught up on %d overdue events, notifying over %s seconds", len(notifications), application.warmup)
+    loop = asyncio.get_running_loop()
+    spacing = application.warmup / len(notifications)
+    for i, notification in enumerate(notifications):
+        loop.call_later(i * spacing, notify, application, *notification)
+
+
+async def migrate_persistence(application: GryphonApplication) -> None:
+    """Move chats still storing every gryphon they ever had to the current layout, and save them."""
+    migrated = [chat_id for chat_id, chat_data in application.chat_data.items()
+                if migrate_chat_data(chat_data, application.history_limit)]
+    if migrated:
+        logger.info("Migrated gryphon history of %d chats", len(migrated))
+        application.mark_data_for_update_persistence(chat_ids=migrated)
+
+
+async def reload_foods(context: ContextTypes.DEFAULT_TYPE) -> None:
+    foods.reload_if_changed()
+
+
+async def save_shard_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Let the other shards know this shard's global stats"""
+    context.application.shard_stats.save(get_global_stats(context.application.bot_data))
+
+
+async def post_init(application: GryphonApplication) -> None:
+    if hasattr(signal, 'SIGHUP'):  # Not on Windows
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, foods.reload)
+    await migrate_persistence(application)
+    await catch_up_overdue_events(application)
+    await schedule_pending_updates(application)
+    if application.hibernation is not None:
+        application.job_queue.run_repeating(application.profiler.timed('hibernate_idle_chats', hibernate_idle_chats),
+                                            name='hibernate_idle_chats',
+                                            interval=min(DEFAULT_SWEEP_INTERVAL, application.hibernation.idle_after))
+    if application.shard_stats is not None:
+        application.job_queue.run_repeating(application.profiler.timed('save_shard_stats', save_shard_stats),
+                                            interval=SHARD_STATS_INTERVAL, first=0., name='save_shard_stats')
+    await application.outbox.start()
+    await application.journal.start()
+    await application.profiler.start()
+
+
+async def post_stop(application: GryphonApplication) -> None:
+    if application.cards is not None:
+        await application.cards.stop()
+    await application.outbox.stop()
+    await application.journal.stop()
+    await application.profiler.stop()
+    if application.shard_stats is not None:
+        application.shard_stats.save(get_global_stats(application.bot_data))
+
+
+def make_dispatcher(callbacks: dict[str, Callable]) -> CallbackQueryHandler:
+    """
+    A single handler for buttons, looking up their callback data instead of matching it against a pattern per handler
+    :param callbacks: Handler callbacks by the name used in keyboards.Callback
+    """
+    def check(data: object) -> bool:
+        callback = keyboards.decode(data)
+        return callback is not None and callback.handler in callbacks
+
+    async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        return await callbacks[keyboards.decode(update.callback_query.data).handler](update, context)
+
+    return CallbackQueryHandler(dispatch, pattern=check)
+
+
+def make_states(timed: Callable[[str, Callable], Callable]) -> dict[str, list[CallbackQueryHandler]]:
+    """:param timed: Wraps each callback to record its latency"""
+    return {'new_gryphon': [make_dispatcher({'new_gryphon': timed('new_gryphon', new_gryphon)})],
+            'gryphon_action': [make_dispatcher({
+                'gryphon_action': timed('gryphon_action', gryphon_action),
+                'gryphon_action_parameter': timed('gryphon_action_parameter', gryphon_action_parameter)})],
+            }
+
+
+DEFAULT_CONCURRENT_UPDATES = 256
+
+# Only the update types the handlers above use
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+
+class PersistenceBackend(str, Enum):
+    pickle = 'pickle'
+    sqlite = 'sqlite'
+
+
+class Mode(str, Enum):
+    polling = 'polling'
+    webhook = 'webhook'
 
-    persistence = PicklePersistence(filepath=persistence_path / 'persistence.pkl')
-    application = Application.builder().token(token).persistence(persistence).build()
 
-    conv_handler = ConversationHandler(
+def make_persistence(persistence_path: Path, backend: PersistenceBackend, on_flush: bool = False) -> BasePersistence:
+    """:param on_flush: Only write the pickle file when flushed, for offline maintenance"""
+    persistence_path.mkdir(parents=True, exist_ok=True)  # create persistence_path if it doesn't exist
+
+    if backend == PersistenceBackend.sqlite:
+        # No handler uses user_data, and storing it would keep every user ever seen loaded, even with hibernation
+        return SQLitePersistence(filepath=persistence_path / 'persistence.sqlite3', preload=has_pending_event,
+                                 store_data=PersistenceInput(user_data=False))
+    return PicklePersistence(filepath=persistence_path / 'persistence.pkl', on_flush=on_flush)
+
+
+def build_application(token: str, persistence: BasePersistence, request: BaseRequest = None,
+                      concurrent_updates: int = DEFAULT_CONCURRENT_UPDATES, fetch_updates: bool = True,
+                      conversation_timeout: float = DEFAULT_CONVERSATION_TIMEOUT,
+                      max_conversations_per_chat: int = DEFAULT_MAX_CONVERSATIONS_PER_CHAT,
+                      foods_path: Path = None, **settings) -> GryphonApplication:
+    """
+    Build the application with all of the bot's handlers
+    :param request: Used instead of the default HTTP client to talk to the Bot API, if given
+    :param fetch_updates: Whether the application gets updates from Telegram itself, rather than having them put in
+                          its update queue, e.g. by a sharding router
+    :param concurrent_updates: How many updates to process at once. Updates for the same chat are still
+                               processed one at a time.
+    :param conversation_timeout: Seconds after which a menu nobody used stops working
+    :param max_conversations_per_chat: Menus that can be open in a chat at once, opening another closes the oldest
+    :param foods_path: Food catalog file to use instead of the bundled one. Either way it's reloaded when it changes.
+    :param settings: Passed on to GryphonApplication
+    """
+    if foods_path is not None:
+        foods.load(foods_path)
+    builder = Application.builder().token(token).persistence(persistence) \
+        .application_class(GryphonApplication, kwargs=settings) \
+        .concurrent_updates(concurrent_updates) \
+        .post_init(post_init).post_stop(post_stop)
+    if not fetch_updates:
+        builder = builder.updater(None)
+    if request is not None:
+        builder = builder.request(request)
+        if fetch_updates:
+            builder = builder.get_updates_request(request)
+    application = builder.build()
+
+    def timed(name: str, callback: Callable) -> Callable:
+        return application.metrics.timed(name, application.profiler.timed(name, callback))
+
+    conv_handler = ExpiringConversationHandler(
         per_user=True, per_message=False,
-        entry_points=[CommandHandler('gryphon', gryphon),
-                      CommandHandler('gryph', gryphon)],
-        states=states,
-        fallbacks=[CommandHandler('gryphon', gryphon)],
+        entry_points=[CommandHandler('gryphon', timed('gryphon', gryphon)),
+                      CommandHandler('gryph', timed('gryphon', gryphon))],
+        states=make_states(timed),
+        fallbacks=[CommandHandler('gryphon', timed('gryphon', gryphon))],
+        expire_after=conversation_timeout, max_per_chat=max_conversations_per_chat,
     )
+    # Jobs aren't handlers, so they're only profiled, like hibernate_idle_chats, and kept out of the latency metrics
+    application.job_queue.run_repeating(application.profiler.timed('expire_conversations', expire_conversations),
+                                        interval=min(60., conversation_timeout),
+                                        data=conv_handler, name='expire_conversations')
+    application.job_queue.run_repeating(application.profiler.timed('reload_foods', reload_foods),
+                                        interval=DEFAULT_RELOAD_INTERVAL, name='reload_foods')
 
     # Add ConversationHandler to application that will be used for handling updates
     application.add_handler(conv_handler)
+    application.add_handler(CommandHandler('gryphonstats', timed('gryphonstats', gryphon_stats)))
+    # Buttons the conversation handler didn't take
+    application.add_handler(CallbackQueryHandler(stale_menu))
+    return application
+
+
+def main(token: Annotated[str, typer.Argument(help='Telegram bot token')],
+         persistence_path: Annotated[Path, typer.Argument(help='Where to save persistence files')],
+         persistence_backend: Annotated[PersistenceBackend, typer.Option(
+             help='Store everything in a single pickle file, or only write changed chats to a SQLite database')]
+         = PersistenceBackend.pickle,
+         history_limit: Annotated[int, typer.Option(help='How many previous gryphons to remember per chat')]
+         = DEFAULT_HISTORY_LIMIT,
+         global_rate: Annotated[float, typer.Option(help='Maximum notifications sent per second over all chats')]
+         = DEFAULT_GLOBAL_RATE,
+         chat_rate: Annotated[float, typer.Option(help='Maximum notifications sent per second to a single chat')]
+         = DEFAULT_CHAT_RATE,
+         mode: Annotated[Mode, typer.Option(help='Fetch updates by long polling, or have Telegram post them to a '
+                                                 'webhook')] = Mode.polling,
+         listen: Annotated[str, typer.Option(help='Address for the webhook server to listen on')] = '127.0.0.1',
+         port: Annotated[int, typer.Option(help='Port for the webhook server to listen on')] = 8443,
+         url_path: Annotated[str, typer.Option(help='Path of the webhook on the webhook server')] = '',
+         webhook_url: Annotated[str, typer.Option(
+             help='Public URL Telegram should post updates to, if it differs from listen, port and url path, '
+                  'e.g. behind a reverse proxy. Needed when listening on a loopback or wildcard address.')] = None,
+         secret_token: Annotated[str, typer.Option(
+             envvar='WEBHOOK_SECRET_TOKEN',
+             help='Only accept webhook requests with this X-Telegram-Bot-Api-Secret-Token header')] = None,
+         metrics_port: Annotated[int, typer.Option(
+             help='Serve Prometheus metrics on this port. Needs the metrics extra')] = None,
+         concurrent_updates: Annotated[int, typer.Option(
+             min=1, help='How many updates to process at once, updates for the same chat are still handled in order')]
+         = DEFAULT_CONCURRENT_UPDATES,
+         warmup: Annotated[float, typer.Option(
+             help='Spread notifications for events that finished while the bot was stopped over this many seconds')]
+         = DEFAULT_WARMUP,
+         journal_path: Annotated[Path, typer.Option(
+             help='Record births, hunts and deaths in a journal in this directory. Read it with '
+                  'gryphon_telegram_bot.journal')] = None,
+         conversation_timeout: Annotated[float, typer.Option(
+             help='Seconds after which a menu nobody used stops working')] = DEFAULT_CONVERSATION_TIMEOUT,
+         max_menus_per_chat: Annotated[int, typer.Option(
+             min=1, help='Menus that can be open in a chat at once, opening another closes the oldest')]
+         = DEFAULT_MAX_CONVERSATIONS_PER_CHAT,
+         hibernate_after: Annotated[float, typer.Option(
+             help='Evict chats from memory after this many seconds without updates, loading them again when they '
+                  'are next used. Needs the sqlite persistence backend')] = None,
+         shards: Annotated[int, typer.Option(
+             min=1, help='Split chats between this many worker processes. Use gryphon_telegram_bot.sharding to '
+                         'rebalance existing persistence when changing it')] = 1,
+         live_card: Annotated[bool, typer.Option(
+             help="Keep one message per chat showing its gryphon and edit it as things happen, at most chat-rate "
+                  "times per second, instead of sending a message for each event")] = False,
+         foods_path: Annotated[Path, typer.Option(
+             '--foods', help='Food catalog to use instead of the bundled one, see data/foods.json. Reloaded when it '
+                             'changes or on SIGHUP')] = None,
+         profile: Annotated[bool, typer.Option(
+             help='Profile the bot with cProfile, writing a snapshot to <persistence_path>/profiles every '
+                  'profile-interval seconds')] = False,
+         profile_interval: Annotated[float, typer.Option(
+             help='Seconds between profile snapshots')] = DEFAULT_SNAPSHOT_INTERVAL,
+         slow_threshold: Annotated[float, typer.Option(
+             help='Log handler calls and job ticks that take at least this many seconds, with their chat and '
+                  'action')] = None) -> None:
+    """Run the bot."""
+    if hibernate_after is not None and persistence_backend != PersistenceBackend.sqlite:
+        raise typer.BadParameter("Pickle persistence keeps every chat in memory, use --persistence-backend sqlite",
+                                 param_hint='--hibernate-after')
+    if mode == Mode.webhook and webhook_url is None and not is_public_address(listen):
+        raise typer.BadParameter(f"Telegram can't post updates to {listen}, give the public URL of the webhook",
+                                 param_hint='--webhook-url')
+    settings = dict(history_limit=history_limit, global_rate=global_rate, chat_rate=chat_rate,
+                    metrics_port=metrics_port, concurrent_updates=concurrent_updates, warmup=warmup,
+                    journal_path=journal_path, hibernate_after=hibernate_after,
+                    conversation_timeout=conversation_timeout, max_conversations_per_chat=max_menus_per_chat,
+                    profile_path=persistence_path / 'profiles' if profile else None,
+                    profile_interval=profile_interval, slow_threshold=slow_threshold, foods_path=foods_path,
+                    live_card=live_card)
+    webhook_settings = dict(listen=listen, port=port, url_path=url_path, webhook_url=webhook_url,
+                            secret_token=secret_token)
+
+    if shards > 1:
+        from .sharding import run_sharded
+        run_sharded(token, persistence_path, persistence_backend, shards, mode, webhook_settings, settings)
+        return
+
+    persistence = make_persistence(persistence_path, persistence_backend)
+    application = build_application(token, persistence, **settings)
+    serve(application, mode, **webhook_settings)
+
+
+def is_public_address(host: str) -> bool:
+    """Whether Telegram could reach a webhook at host, as far as can be told without resolving it"""
+    if host == 'localhost':
+        return False
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:  # A host name
+        return True
+    return not (address.is_loopback or address.is_unspecified)
 
-    # Add a job queue to the application
-    job_queue = application.job_queue
-    update_gryphons_job = job_queue.run_repeating(update_gryphon, interval=3, first=5, data=application.chat_data)
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+def serve(application: Application, mode: Mode, **webhook_settings) -> None:
+    """Run the bot until the user presses Ctrl-C"""
+    if mode == Mode.webhook:
+        application.run_webhook(allowed_updates=ALLOWED_UPDATES, **webhook_settings)
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
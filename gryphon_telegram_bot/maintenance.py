@@ -0,0 +1,335 @@
+"""
+Offline maintenance of a persistence store: inspect, compact, migrate, export and import chat data.
+With the SQLite backend chats are read and written one at a time, so stores of any size can be maintained in little
+memory. A pickle store can only be loaded whole. Run on one shard at a time when sharded.
+"""
+from __future__ import annotations
+
+import importlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+from collections import Counter, deque
+from pathlib import Path
+from typing import Any, Iterator
+
+import typer
+from typing_extensions import Annotated
+
+from .gryphon import State
+from .history import DEFAULT_HISTORY_LIMIT, get_gryphon, migrate_chat_data
+from .main import PersistenceBackend, has_pending_event
+from .persistence import SCHEMA
+
+logger = logging.getLogger(__name__)
+
+app = typer.Typer(help=__doc__)
+
+BATCH_SIZE = 1000
+PACKAGE = __package__ + '.'
+
+
+class SQLiteStore(object):
+    """Reads chats through one connection while writing through another, committing every BATCH_SIZE writes."""
+
+    def __init__(self, filepath: Path):
+        self.reader = sqlite3.connect(filepath)
+        self.writer = sqlite3.connect(filepath, isolation_level=None)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.executescript(SCHEMA)
+        self._writes = 0
+
+    def iter_chats(self) -> Iterator[tuple[int, bytes]]:
+        """:return: Iterator of (chat id, pickled chat data)"""
+        yield from self.reader.execute("SELECT id, data FROM chat_data")
+
+    def _write(self, sql: str, parameters: tuple) -> None:
+        if self._writes == 0:
+            self.writer.execute("BEGIN")
+        self.writer.execute(sql, parameters)
+        self._writes += 1
+        if self._writes >= BATCH_SIZE:
+            self.commit()
+
+    def commit(self) -> None:
+        if self._writes:
+            self.writer.execute("COMMIT")
+            self._writes = 0
+
+    def write_chat(self, chat_id: int, data: dict) -> None:
+        self._write("INSERT OR REPLACE INTO chat_data (id, data, preload) VALUES (?, ?, ?)",
+                    (chat_id, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL), has_pending_event(data)))
+
+    def delete_chat(self, chat_id: int) -> None:
+        self._write("DELETE FROM chat_data WHERE id = ?", (chat_id,))
+
+    def count_conversations(self) -> int:
+        return self.reader.execute("SELECT count(*) FROM conversations").fetchone()[0]
+
+    def clear_conversations(self) -> None:
+        self._write("DELETE FROM conversations", ())
+
+    def close(self, vacuum: bool = False) -> None:
+        self.commit()
+        self.reader.close()
+        if vacuum:
+            self.writer.execute("VACUUM")
+        self.writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.writer.close()
+
+
+class PickleStore(object):
+    """Loads a PicklePersistence file whole, and replaces it when closed if anything was changed."""
+
+    def __init__(self, filepath: Path):
+        self.filepath = filepath
+        try:
+            with open(filepath, 'rb') as f:
+                self.data = pickle.load(f)
+        except FileNotFoundError:  # Only opened without a file to create one
+            self.data = {'conversations': {}, 'user_data': {}, 'chat_data': {}, 'bot_data': {},
+                         'callback_data': None}
+        self.changed = False
+
+    def iter_chats(self) -> Iterator[tuple[int, bytes]]:
+        for chat_id, data in list(self.data['chat_data'].items()):
+            yield chat_id, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def write_chat(self, chat_id: int, data: dict) -> None:
+        self.data['chat_data'][chat_id] = data
+        self.changed = True
+
+    def delete_chat(self, chat_id: int) -> None:
+        del self.data['chat_data'][chat_id]
+        self.changed = True
+
+    def count_conversations(self) -> int:
+        return sum(len(conversations) for conversations in self.data['conversations'].values())
+
+    def clear_conversations(self) -> None:
+        self.data['conversations'] = {}
+        self.changed = True
+
+    def commit(self) -> None:
+        pass
+
+    def close(self, vacuum: bool = False) -> None:
+        if self.changed:
+            temporary = self.filepath.with_suffix('.tmp')
+            with open(temporary, 'wb') as f:
+                pickle.dump(self.data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self.filepath)
+
+
+def open_store(persistence_path: Path, backend: PersistenceBackend, create: bool = False) -> SQLiteStore | PickleStore:
+    """:param create: Start an empty store if there is none, instead of failing, e.g. when a path was mistyped"""
+    filepath = persistence_path / ('persistence.sqlite3' if backend == PersistenceBackend.sqlite else 'persistence.pkl')
+    if not filepath.exists():
+        if not create:
+            raise typer.BadParameter(f"There is no {backend.value} store in {persistence_path}, expected {filepath}",
+                                     param_hint='persistence_path')
+        persistence_path.mkdir(parents=True, exist_ok=True)
+    if backend == PersistenceBackend.sqlite:
+        return SQLiteStore(filepath)
+    return PickleStore(filepath)
+
+
+def to_json(value: Any) -> Any:
+    """
+    Convert chat data to JSON compatible values, tagging anything JSON has no type for so from_json can restore it.
+    Objects of this package are stored with the state they pickle with.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [to_json(item) for item in value]
+    if isinstance(value, Counter):
+        return {'__counter__': to_json(dict(value))}
+    if isinstance(value, dict):
+        if all(isinstance(key, str) and not key.startswith('__') for key in value):
+            return {key: to_json(item) for key, item in value.items()}
+        return {'__items__': [[to_json(key), to_json(item)] for key, item in value.items()]}
+    if isinstance(value, deque):
+        return {'__deque__': to_json(list(value)), 'maxlen': value.maxlen}
+
+    cls = type(value)
+    if not cls.__module__.startswith(PACKAGE):
+        if isinstance(value, tuple):
+            return {'__tuple__': to_json(list(value))}
+        raise TypeError(f"Can't export {cls.__module__}.{cls.__qualname__}")
+    name = f'{cls.__module__}:{cls.__qualname__}'
+    if isinstance(value, tuple):  # NamedTuple
+        return {'__object__': name, 'fields': to_json(list(value))}
+    if '__getstate__' in vars(cls):
+        state = value.__getstate__()
+    elif hasattr(value, '__dict__'):
+        state = vars(value)
+    else:
+        state = {slot: getattr(value, slot) for slot in cls.__slots__}
+    return {'__object__': name, 'state': to_json(state)}
+
+
+def from_json(value: Any) -> Any:
+    """Restore chat data converted by to_json."""
+    if isinstance(value, list):
+        return [from_json(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if '__counter__' in value:
+        return Counter(from_json(value['__counter__']))
+    if '__items__' in value:
+        return {_hashable(from_json(key)): from_json(item) for key, item in value['__items__']}
+    if '__deque__' in value:
+        return deque(from_json(value['__deque__']), maxlen=value['maxlen'])
+    if '__tuple__' in value:
+        return tuple(from_json(value['__tuple__']))
+    if '__object__' not in value:
+        return {key: from_json(item) for key, item in value.items()}
+
+    module, _, qualname = value['__object__'].partition(':')
+    if not module.startswith(PACKAGE):
+        raise ValueError(f"Refusing to import {value['__object__']}")
+    cls = importlib.import_module(module)
+    for part in qualname.split('.'):
+        cls = getattr(cls, part)
+    if 'fields' in value:
+        return cls(*from_json(value['fields']))
+
+    state = from_json(value['state'])
+    obj = cls.__new__(cls)
+    if '__setstate__' in vars(cls):
+        obj.__setstate__(state)
+    elif hasattr(obj, '__dict__'):
+        obj.__dict__.update(state)
+    else:
+        for slot, item in state.items():
+            setattr(obj, slot, item)
+    return obj
+
+
+def _hashable(value: Any) -> Any:
+    """Lists that were tuples before going through JSON, e.g. dictionary keys, become tuples again."""
+    return tuple(_hashable(item) for item in value) if isinstance(value, list) else value
+
+
+def _open(path: Path, mode: str):
+    if str(path) == '-':
+        return open(sys.stdout.fileno() if 'w' in mode else sys.stdin.fileno(), mode, closefd=False)
+    return open(path, mode, encoding='utf-8')
+
+
+PersistencePath = Annotated[Path, typer.Argument(help='Where persistence files are saved')]
+Backend = Annotated[PersistenceBackend, typer.Option()]
+
+
+@app.command()
+def inspect(persistence_path: PersistencePath, persistence_backend: Backend = PersistenceBackend.pickle,
+            top: Annotated[int, typer.Option(help='How many of the largest chats to list')] = 10) -> None:
+    """Print the size of the largest chats and how many gryphons are stored."""
+    store = open_store(persistence_path, persistence_backend)
+    chats = total_bytes = alive = dead = history = 0
+    largest: list[tuple[int, int]] = []
+    for chat_id, blob in store.iter_chats():
+        chats += 1
+        total_bytes += len(blob)
+        data = pickle.loads(blob)
+        gryphon = data.get('gryphon')
+        if gryphon is None and data.get('gryphons'):  # Not migrated yet
+            gryphon = data['gryphons'][-1]
+            history += len(data['gryphons']) - 1
+        if gryphon is not None:
+            if gryphon.state == State.DEAD:
+                dead += 1
+            else:
+                alive += 1
+        history += len(data.get('history', []))
+        largest.append((len(blob), chat_id))
+        if len(largest) > 2 * top:
+            largest = sorted(largest, reverse=True)[:top]
+
+    typer.echo(json.dumps({
+        'chats': chats, 'chat_data_bytes': total_bytes, 'conversations': store.count_conversations(),
+        'gryphons': {'alive': alive, 'dead': dead, 'in_history': history},
+        'largest_chats': [{'chat': chat_id, 'bytes': size} for size, chat_id in sorted(largest, reverse=True)[:top]],
+    }, indent=2))
+    store.close()
+
+
+@app.command()
+def compact(persistence_path: PersistencePath, persistence_backend: Backend = PersistenceBackend.pickle,
+            history_limit: Annotated[int, typer.Option(help='Previous gryphons to keep per chat')] = 0) -> None:
+    """Drop the history of previous gryphons beyond history_limit, empty chats and stored conversations."""
+    store = open_store(persistence_path, persistence_backend)
+    changed = deleted = 0
+    for chat_id, blob in store.iter_chats():
+        data = pickle.loads(blob)
+        modified = migrate_chat_data(data, history_limit)
+        history = data.get('history')
+        if history is not None and len(history) > history_limit:
+            del history[:len(history) - history_limit]
+            modified = True
+        if not data:
+            store.delete_chat(chat_id)
+            deleted += 1
+        elif modified:
+            store.write_chat(chat_id, data)
+            changed += 1
+    conversations = store.count_conversations()
+    store.clear_conversations()
+    store.close(vacuum=True)
+    logger.info("Compacted %d chats, deleted %d empty chats and %d conversations", changed, deleted, conversations)
+
+
+@app.command()
+def migrate(persistence_path: PersistencePath, persistence_backend: Backend = PersistenceBackend.pickle,
+            history_limit: Annotated[int, typer.Option(
+                help='Previous gryphons to keep per chat when moving them to the current layout')]
+            = DEFAULT_HISTORY_LIMIT) -> None:
+    """Rewrite every chat in the current format, upgrading gryphons pickled by older versions."""
+    store = open_store(persistence_path, persistence_backend)
+    n = 0
+    for chat_id, blob in store.iter_chats():
+        data = pickle.loads(blob)  # Gryphons are upgraded as they are unpickled
+        migrate_chat_data(data, history_limit)
+        get_gryphon(data, history_limit)
+        store.write_chat(chat_id, data)
+        n += 1
+    store.close()
+    logger.info("Migrated %d chats", n)
+
+
+@app.command()
+def export(persistence_path: PersistencePath,
+           output: Annotated[Path, typer.Argument(help="File to write, - for stdout")],
+           persistence_backend: Backend = PersistenceBackend.pickle) -> None:
+    """Write every chat's data as a line of JSON."""
+    store = open_store(persistence_path, persistence_backend)
+    with _open(output, 'w') as f:
+        for chat_id, blob in store.iter_chats():
+            f.write(json.dumps({'chat': chat_id, 'data': to_json(pickle.loads(blob))}, ensure_ascii=False) + '\n')
+    store.close()
+
+
+@app.command(name='import')
+def import_(persistence_path: PersistencePath,
+            source: Annotated[Path, typer.Argument(help="File to read, - for stdin")],
+            persistence_backend: Backend = PersistenceBackend.pickle,
+            create: Annotated[bool, typer.Option(help="Create the store if it doesn't exist yet")] = False) -> None:
+    """Write chats exported by export, replacing stored chats with the same id."""
+    store = open_store(persistence_path, persistence_backend, create=create)
+    n = 0
+    with _open(source, 'r') as f:
+        for line in f:
+            if line.strip():
+                chat = json.loads(line)
+                store.write_chat(chat['chat'], from_json(chat['data']))
+                n += 1
+    store.close()
+    logger.info("Imported %d chats", n)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import functools
+import logging
+from time import perf_counter
+from typing import Callable, TYPE_CHECKING
+
+try:
+    import prometheus_client
+except ImportError:  # Optional, install with the metrics extra
+    prometheus_client = None
+
+if TYPE_CHECKING:
+    from .application import GryphonApplication
+    from .food import HuntOutcome
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """Does nothing. Used when metrics are disabled, so instrumented code doesn't need to check."""
+
+    def timed(self, name: str, callback: Callable) -> Callable:
+        """Wrap an async handler callback to record its latency under name."""
+        return callback
+
+    def observe_update(self, seconds: float) -> None:
+        """Record how long finishing a gryphon's event took."""
+
+    def observe_persistence_flush(self, seconds: float) -> None:
+        pass
+
+    def hunt(self, outcome: HuntOutcome) -> None:
+        pass
+
+    def birth(self) -> None:
+        pass
+
+    def death(self) -> None:
+        pass
+
+
+class PrometheusMetrics(Metrics):
+    """Exports metrics in the Prometheus text format over HTTP."""
+
+    def __init__(self, application: GryphonApplication, port: int, address: str = '0.0.0.0'):
+        if prometheus_client is None:
+            raise RuntimeError("Metrics need prometheus_client, install gryphon-telegram-bot[metrics]")
+
+        self.registry = prometheus_client.CollectorRegistry()
+        self.handler_seconds = prometheus_client.Histogram(
+            'gryphon_handler_seconds', 'Time taken to handle an update', ['handler'], registry=self.registry)
+        self.update_seconds = prometheus_client.Histogram(
+            'gryphon_update_seconds', "Time taken to finish a gryphon's event", registry=self.registry)
+        self.persistence_flush_seconds = prometheus_client.Histogram(
+            'gryphon_persistence_flush_seconds', 'Time taken to save changed data to persistence',
+            buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60), registry=self.registry)
+        self.hunts = prometheus_client.Counter(
+            'gryphon_hunts', 'Hunts finished', ['category', 'outcome'], registry=self.registry)
+        self.births = prometheus_client.Counter('gryphon_births', 'Gryphons summoned', registry=self.registry)
+        self.deaths = prometheus_client.Counter('gryphon_deaths', 'Gryphons died', registry=self.registry)
+
+        prometheus_client.Gauge('gryphon_live_chats', 'Chats loaded in memory', registry=self.registry) \
+            .set_function(lambda: len(application.chat_data))
+        prometheus_client.Gauge('gryphon_scheduled_jobs', 'Jobs waiting in the job queue, mostly busy gryphons',
+                                registry=self.registry) \
+            .set_function(lambda: len(application.job_queue.scheduler.get_jobs()))
+        prometheus_client.Gauge('gryphon_outbox_depth', 'Chats with notifications waiting to be sent',
+                                registry=self.registry) \
+            .set_function(lambda: application.outbox.depth)
+        prometheus_client.Gauge('gryphon_outbox_dropped', 'Notifications dropped by the outbox',
+                                registry=self.registry) \
+            .set_function(lambda: application.outbox.dropped)
+
+        prometheus_client.start_http_server(port, addr=address, registry=self.registry)
+        logger.info("Serving metrics on %s:%d", address, port)
+
+    def timed(self, name: str, callback: Callable) -> Callable:
+        histogram = self.handler_seconds.labels(name)
+
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - start)
+        return wrapper
+
+    def observe_update(self, seconds: float) -> None:
+        self.update_seconds.observe(seconds)
+
+    def observe_persistence_flush(self, seconds: float) -> None:
+        self.persistence_flush_seconds.observe(seconds)
+
+    def hunt(self, outcome: HuntOutcome) -> None:
+        label = 'died' if outcome.died else 'caught' if outcome.success else 'missed'
+        self.hunts.labels(outcome.food.category, label).inc()
+
+    def birth(self) -> None:
+        self.births.inc()
+
+    def death(self) -> None:
+        self.deaths.inc()
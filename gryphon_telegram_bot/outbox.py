@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+from typing import Union
+
+from telegram import Bot
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall, and 20 per minute in a group
+DEFAULT_GLOBAL_RATE = 25.
+DEFAULT_CHAT_RATE = 20 / 60
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float = 1.):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+    def take(self) -> float:
+        """
+        Take a token if one is available
+        :return: 0 if a token was taken, otherwise how long to wait until one is available
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.
+        return (1 - self.tokens) / self.rate
+
+
+class Outbox(object):
+    """
+    Sends notifications in the background, respecting global and per chat rate limits. Notifications queued for a
+    chat while it is waiting for its turn are merged into a single message.
+    """
+
+    def __init__(self, bot: Bot, global_rate: float = DEFAULT_GLOBAL_RATE, chat_rate: float = DEFAULT_CHAT_RATE,
+                 chat_burst: float = 3., workers: int = 8, max_pending: int = 10000):
+        """
+        :param global_rate: Messages per second over all chats
+        :param chat_rate: Messages per second to a single chat
+        :param chat_burst: How many messages a chat can receive at once after being quiet
+        :param workers: Number of messages that can be sent concurrently
+        :param max_pending: Notifications beyond this many waiting chats are dropped
+        """
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.n_workers = workers
+        self.max_pending = max_pending
+
+        self.global_bucket = TokenBucket(global_rate, burst=global_rate)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self._prune_buckets_at = max_pending
+
+        self.pending: dict[int, deque[str]] = {}  # Notifications waiting to be sent, by chat
+        self.scheduled: set[int] = set()  # Chats that are queued, waiting for a rate limit or being sent to
+        self.queue: Union[asyncio.Queue, None] = None
+        self.workers: list[asyncio.Task] = []
+
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.retries = 0
+
+    @property
+    def depth(self) -> int:
+        """Number of chats with notifications waiting to be sent."""
+        return len(self.pending)
+
+    def send(self, chat_id: int, text: str) -> bool:
+        """
+        Queue a notification
+        :return: False if the notification was dropped because too many are pending
+        """
+        if chat_id in self.pending:
+            self.pending[chat_id].append(text)
+            self.merged += 1
+            return True
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            logger.warning("Outbox full, dropping message to %d", chat_id)
+            return False
+
+        self.pending[chat_id] = deque((text,))
+        self._schedule(chat_id)
+        return True
+
+    def _schedule(self, chat_id: int, delay: float = 0.) -> None:
+        self.scheduled.add(chat_id)
+        if self.queue is None:  # Not started yet, messages are picked up once it is
+            return
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, chat_id)
+        else:
+            self.queue.put_nowait(chat_id)
+
+    def _take_text(self, chat_id: int) -> str:
+        """Merge as many of a chat's pending notifications as fit in one message."""
+        texts = self.pending[chat_id]
+        text = texts.popleft()
+        while texts and len(text) + 2 + len(texts[0]) <= MessageLimit.MAX_TEXT_LENGTH:
+            text = f"{text}\n\n{texts.popleft()}"
+        return text
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self.queue.get()
+
+            chat_bucket = self.chat_buckets.get(chat_id)
+            if chat_bucket is None:
+                chat_bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            delay = chat_bucket.take()
+            if delay:
+                self._schedule(chat_id, delay)
+                continue
+            while delay := self.global_bucket.take():
+                await asyncio.sleep(delay)
+
+            text = self._take_text(chat_id)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                self.sent += 1
+            except RetryAfter as e:
+                logger.warning("Flood limit hit sending to %d, retrying in %s seconds", chat_id, e.retry_after)
+                self.retries += 1
+                self.pending[chat_id].appendleft(text)
+                self._schedule(chat_id, e.retry_after)
+                continue
+            except TelegramError as e:
+                logger.warning("Could not send message to %d: %s", chat_id, e)
+                self.dropped += 1
+            except Exception:
+                logger.exception("Error sending message to %d", chat_id)
+                self.dropped += 1
+
+            if self.pending[chat_id]:
+                self._schedule(chat_id)
+            else:
+                del self.pending[chat_id]
+                self.scheduled.discard(chat_id)
+
+            if len(self.chat_buckets) > self._prune_buckets_at:
+                self._prune_buckets()
+
+    def _prune_buckets(self) -> None:
+        """Forget the rate limits of chats that haven't been sent anything recently."""
+        self.chat_buckets = {chat_id: bucket for chat_id, bucket in self.chat_buckets.items()
+                             if chat_id in self.scheduled or not bucket.full}
+        self._prune_buckets_at = max(self.max_pending, 2 * len(self.chat_buckets))
+
+    async def start(self) -> None:
+        self.queue = asyncio.Queue()
+        for chat_id in self.scheduled:
+            self.queue.put_nowait(chat_id)
+        self.workers = [asyncio.create_task(self._worker(), name=f"Outbox:worker:{i}")
+                        for i in range(self.n_workers)]
+
+    async def stop(self, timeout: float = 5.) -> None:
+        """Give pending messages up to timeout seconds to be sent, then stop."""
+        deadline = monotonic() + timeout
+        while self.pending and monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.pending:
+            logger.warning("Stopping with messages pending for %d chats", len(self.pending))
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.queue = None
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import pickle
+import sqlite3
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL, preload INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS chat_data_preload ON chat_data (preload) WHERE preload;
+CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL,
+                                          PRIMARY KEY (name, key));
+CREATE TABLE IF NOT EXISTS singletons (name TEXT PRIMARY KEY, data BLOB NOT NULL);
+"""
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Persistence backed by a SQLite database in WAL mode.
+
+    Unlike PicklePersistence, only chats, users and conversation keys that changed since they were last written are
+    saved, and chat and user data is only loaded from disk when an update or job for that chat or user arrives.
+    Chats for which ``preload`` returns True are loaded at startup instead, e.g. so that pending events can be
+    rescheduled.
+    """
+
+    def __init__(self, filepath: Path, store_data: PersistenceInput = None, update_interval: float = 60,
+                 preload: Callable[[dict], bool] = None):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.filepath = Path(filepath)
+        self.preload = preload
+
+        self._conn: Optional[sqlite3.Connection] = None
+        self._loaded: dict[str, set[int]] = {'chat_data': set(), 'user_data': set()}
+        self._written: dict[tuple, int] = {}  # Hash of the last blob written for each row
+        self._pending: dict[tuple, Optional[tuple]] = {}  # Rows waiting to be committed, None to delete
+        self._commit_scheduled = False
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filepath)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    @staticmethod
+    def _dumps(data: Any) -> bytes:
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _mark_dirty(self, row: tuple, blob: Optional[bytes], *extra) -> None:
+        """
+        Queue a row to be written if it changed since it was last written. All rows queued in the same
+        iteration of the event loop are committed in a single transaction.
+        :param row: Tuple of (table, key)
+        :param blob: Pickled data, or None to delete the row
+        :param extra: Additional column values stored with the row
+        """
+        if blob is None:  # Deleted rows aren't remembered, so ended conversations don't pile up here
+            self._written.pop(row, None)
+        else:
+            digest = hash(blob)
+            if self._written.get(row) == digest:
+                return
+            self._written[row] = digest
+        self._pending[row] = None if blob is None else (blob, *extra)
+
+        if not self._commit_scheduled:
+            self._commit_scheduled = True
+            try:
+                asyncio.get_running_loop().call_soon(self._commit)
+            except RuntimeError:  # No running loop, e.g. called from a maintenance script
+                self._commit()
+
+    def _commit(self) -> None:
+        self._commit_scheduled = False
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        with self.conn:
+            for (table, key), values in pending.items():
+                if table == 'conversations':
+                    name, key = key
+                    if values is None:
+                        self.conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+                    else:
+                        self.conn.execute("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                                          (name, key, *values))
+                elif table == 'singletons':
+                    self.conn.execute("INSERT OR REPLACE INTO singletons (name, data) VALUES (?, ?)", (key, *values))
+                elif values is None:
+                    self.conn.execute(f"DELETE FROM {table} WHERE id = ?", (key,))
+                elif table == 'chat_data':
+                    self.conn.execute("INSERT OR REPLACE INTO chat_data (id, data, preload) VALUES (?, ?, ?)",
+                                      (key, *values))
+                else:
+                    self.conn.execute(f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)", (key, *values))
+        logger.debug("Wrote %d rows to %s", len(pending), self.filepath)
+
+    def _load_row(self, table: str, key: int) -> Optional[Any]:
+        if (table, key) in self._pending:  # Written but not committed yet
+            values = self._pending[(table, key)]
+            return None if values is None else pickle.loads(values[0])
+        row = self.conn.execute(f"SELECT data FROM {table} WHERE id = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._written[(table, key)] = hash(row[0])
+        return pickle.loads(row[0])
+
+    def _load_singleton(self, name: str) -> Optional[Any]:
+        row = self.conn.execute("SELECT data FROM singletons WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        self._written[('singletons', name)] = hash(row[0])
+        return pickle.loads(row[0])
+
+    def iter_chat_data(self) -> Iterator[tuple[int, dict]]:
+        """Load every stored chat, one at a time."""
+        for chat_id, blob in self.conn.execute("SELECT id, data FROM chat_data"):
+            yield chat_id, pickle.loads(blob)
+
+    def iter_user_data(self) -> Iterator[tuple[int, dict]]:
+        """Load every stored user, one at a time."""
+        for user_id, blob in self.conn.execute("SELECT id, data FROM user_data"):
+            yield user_id, pickle.loads(blob)
+
+    async def get_user_data(self) -> dict[int, dict]:
+        return {}  # Loaded lazily in refresh_user_data
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        chat_data = {}
+        for chat_id, blob in self.conn.execute("SELECT id, data FROM chat_data WHERE preload"):
+            self._written[('chat_data', chat_id)] = hash(blob)
+            self._loaded['chat_data'].add(chat_id)
+            chat_data[chat_id] = pickle.loads(blob)
+        logger.info("Preloaded %d chats from %s", len(chat_data), self.filepath)
+        return chat_data
+
+    async def get_bot_data(self) -> dict:
+        data = self._load_singleton('bot_data')
+        return {} if data is None else data
+
+    async def get_callback_data(self) -> Optional[tuple]:
+        return self._load_singleton('callback_data')
+
+    async def get_conversations(self, name: str) -> dict[tuple, object]:
+        conversations = {}
+        for key, blob in self.conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)):
+            self._written[('conversations', (name, key))] = hash(blob)
+            conversations[tuple(json.loads(key))] = pickle.loads(blob)
+        return conversations
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        self._mark_dirty(('conversations', (name, json.dumps(key))),
+                         None if new_state is None else self._dumps(new_state))
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._loaded['user_data'].add(user_id)
+        self._mark_dirty(('user_data', user_id), self._dumps(data))
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._loaded['chat_data'].add(chat_id)
+        self._write_chat_data(chat_id, data)
+
+    def _write_chat_data(self, chat_id: int, data: dict) -> None:
+        preload = bool(self.preload and self.preload(data))
+        self._mark_dirty(('chat_data', chat_id), self._dumps(data), preload)
+
+    def evict_chat_data(self, chat_id: int, data: dict) -> None:
+        """Save a chat's data and forget it was loaded, so it is loaded from disk again when next needed."""
+        self._write_chat_data(chat_id, data)
+        self._loaded['chat_data'].discard(chat_id)
+        # The row is already queued to be written, it will be compared with what is stored again once reloaded
+        self._written.pop(('chat_data', chat_id), None)
+
+    async def update_bot_data(self, data: dict) -> None:
+        self._mark_dirty(('singletons', 'bot_data'), self._dumps(data))
+
+    async def update_callback_data(self, data: tuple) -> None:
+        self._mark_dirty(('singletons', 'callback_data'), self._dumps(data))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._loaded['chat_data'].discard(chat_id)
+        self._mark_dirty(('chat_data', chat_id), None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded['user_data'].discard(user_id)
+        self._mark_dirty(('user_data', user_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id not in self._loaded['user_data']:
+            self._loaded['user_data'].add(user_id)
+            user_data.update(self._load_row('user_data', user_id) or {})
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        if chat_id not in self._loaded['chat_data']:
+            self._loaded['chat_data'].add(chat_id)
+            chat_data.update(self._load_row('chat_data', chat_id) or {})
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        self._commit()
+        if self._conn is not None:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,136 @@
+"""
+Finding out where time goes when latency spikes: logging handler calls and job ticks that take longer than a
+threshold, and optionally profiling the whole event loop with cProfile, saving a snapshot every so often.
+Read snapshots with `python -m pstats <file>` or a viewer like snakeviz.
+"""
+from __future__ import annotations
+
+import asyncio
+import cProfile
+import functools
+import logging
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Optional
+
+from telegram import Update
+
+from .keyboards import keyboards
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_INTERVAL = 300.
+
+
+class Profiler(object):
+    """Logs calls slower than slow_threshold, or does nothing if it isn't given, so callers don't need to check."""
+
+    def __init__(self, slow_threshold: float = None):
+        """:param slow_threshold: Log handler calls and job ticks that take at least this many seconds"""
+        self.slow_threshold = slow_threshold
+
+    def timed(self, name: str, callback: Callable) -> Callable:
+        """Wrap an async handler or job callback to log it if it's slow."""
+        if self.slow_threshold is None:
+            return callback
+
+        @functools.wraps(callback)
+        async def wrapper(*args):
+            start = perf_counter()
+            try:
+                return await callback(*args)
+            finally:
+                seconds = perf_counter() - start
+                if seconds >= self.slow_threshold:
+                    self.observe(name, seconds, *describe_call(args))
+        return wrapper
+
+    def observe(self, name: str, seconds: float, chat_id: int = None, action: str = None) -> None:
+        """Log a call that took seconds if that's slow"""
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            logger.warning("Slow %s: %.3fs in chat %s, action %s", name, seconds, chat_id, action)
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class CProfileProfiler(Profiler):
+    """
+    Profiles everything that runs on the event loop's thread, writing the profile collected so far to
+    profile-<time>.pstats in directory every interval seconds and starting over. Work done in executor threads, like
+    the journal's writes, isn't included.
+    """
+
+    def __init__(self, directory: Path, interval: float = DEFAULT_SNAPSHOT_INTERVAL, slow_threshold: float = None):
+        super().__init__(slow_threshold)
+        self.directory = Path(directory)
+        self.interval = interval
+        self._profile: Optional[cProfile.Profile] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _restart(self) -> Optional[cProfile.Profile]:
+        """:return: The profile that was running, if any"""
+        profile = self._profile
+        if profile is not None:
+            profile.disable()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        return profile
+
+    async def snapshot(self, restart: bool = True) -> Path:
+        """Write the profile collected since the last snapshot, in a thread as large profiles take a while."""
+        if restart:
+            profile = self._restart()
+        else:
+            profile, self._profile = self._profile, None
+            profile.disable()
+        path = self.directory / f'profile-{datetime.now():%Y%m%d-%H%M%S-%f}.pstats'
+        await asyncio.get_running_loop().run_in_executor(None, profile.dump_stats, path)
+        logger.info("Wrote profile snapshot %s", path)
+        return path
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.snapshot()
+            except OSError:
+                logger.exception("Could not write a profile snapshot to %s", self.directory)
+
+    async def start(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._restart()
+        self._task = asyncio.create_task(self._run(), name='Profiler:snapshots')
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._profile is not None:
+            await self.snapshot(restart=False)
+
+
+def describe_call(args: tuple) -> tuple[Optional[int], Optional[str]]:
+    """
+    :param args: Arguments of a handler callback, (update, context), or of a job callback, (context,)
+    :return: Tuple of (chat id, action), the action being the button or command that was used, or the job's name
+    """
+    update = args[0] if isinstance(args[0], Update) else None
+    if update is None:
+        job = args[-1].job
+        return job.chat_id, job.name
+    chat_id = update.effective_chat.id if update.effective_chat is not None else None
+    if update.callback_query is not None:
+        callback = keyboards.decode(update.callback_query.data)
+        return chat_id, (callback.action or callback.handler) if callback is not None else update.callback_query.data
+    if update.message is not None:
+        return chat_id, update.message.text
+    return chat_id, None
@@ -0,0 +1,247 @@
+"""
+Run the bot as several worker processes, each owning the chats in one shard with its own persistence and job queue.
+A router process fetches updates from Telegram and passes each one to the worker owning its chat.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+from datetime import datetime
+from pathlib import Path
+from queue import Empty
+from typing import Iterable
+
+import typer
+from typing_extensions import Annotated
+from telegram import Update
+from telegram.ext import Application, BasePersistence, ContextTypes, PicklePersistence, TypeHandler
+
+from .main import Mode, PersistenceBackend, build_application, make_persistence, serve
+from .persistence import SQLitePersistence
+from .stats import get_global_stats
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'shards.json'
+WORKER_CHECK_INTERVAL = 5.
+ROUTER_CHECK_INTERVAL = 1.
+
+
+def shard_for(key: int, shards: int) -> int:
+    return key % shards
+
+
+def get_shard_count(persistence_path: Path) -> int:
+    """Number of shards the persistence in persistence_path is split into."""
+    try:
+        return json.loads((persistence_path / MANIFEST).read_text())['shards']
+    except FileNotFoundError:
+        return 1
+
+
+def shard_path(persistence_path: Path, index: int, shards: int) -> Path:
+    if shards == 1:
+        return persistence_path
+    return persistence_path / 'shards' / str(index)
+
+
+def route_key(update: Update) -> int:
+    """Updates are routed by chat, or by user for the few without a chat, like callback queries from inline messages"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+
+async def _run_worker(index: int, token: str, persistence_path: Path, backend: PersistenceBackend,
+                      queue: multiprocessing.Queue, settings: dict) -> None:
+    application = build_application(token, make_persistence(persistence_path, backend), fetch_updates=False,
+                                    **settings)
+    loop = asyncio.get_running_loop()
+    router = multiprocessing.parent_process()
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        logger.info("Shard %d started", index)
+
+        while True:
+            try:
+                data = await loop.run_in_executor(None, queue.get, True, ROUTER_CHECK_INTERVAL)
+            except Empty:
+                # The router normally says when to stop, but can't if it was killed
+                if not router.is_alive():
+                    logger.error("Router stopped without stopping shard %d, stopping", index)
+                    break
+                continue
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+
+        await application.stop()
+        await application.post_stop(application)
+    logger.info("Shard %d stopped", index)
+
+
+def run_worker(index: int, token: str, persistence_path: Path, backend: PersistenceBackend,
+               queue: multiprocessing.Queue, settings: dict) -> None:
+    # The router tells workers when to stop, so that no updates routed to them are lost. Workers also stop by
+    # themselves once the router is gone.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if hasattr(signal, 'SIGHUP'):  # Until post_init reloads the food catalog on it
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, token, persistence_path, backend, queue, settings))
+
+
+def run_sharded(token: str, persistence_path: Path, backend: PersistenceBackend, shards: int, mode: Mode,
+                webhook_settings: dict, settings: dict) -> None:
+    """
+    Start a worker process per shard and route updates to them until the user presses Ctrl-C, or a worker dies
+    :param settings: Passed on to build_application in each worker. The global rate limit is split between workers
+                     and each worker serves metrics on its own port, counting up from metrics_port, and writes
+                     its own journal and profiles in directories under journal_path and profile_path. Workers
+                     share their global stats through files in the shards directory.
+    """
+    if (current := get_shard_count(persistence_path)) != shards:
+        raise typer.BadParameter(f"Persistence in {persistence_path} is split into {current} shards, run "
+                                 f"'python -m gryphon_telegram_bot.sharding' to rebalance it first")
+
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        queues[shard_for(route_key(update), shards)].put(json.dumps(update.to_dict()))
+
+    async def check_workers(context: ContextTypes.DEFAULT_TYPE) -> None:
+        # Updates for a dead worker's chats would pile up in its queue, so stop instead of carrying on without it
+        for index, worker in enumerate(workers):
+            if not worker.is_alive() and index not in failed:
+                logger.error("Shard %d stopped with exit code %s, stopping the bot", index, worker.exitcode)
+                failed.append(index)
+        if failed:
+            context.application.stop_running()
+
+    def forward_sighup(signum, frame) -> None:
+        # Each worker has its own food catalog to reload, the router doesn't use it
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGHUP)
+
+    # Built before any worker is started, so that workers aren't left waiting for updates if it fails
+    router = Application.builder().token(token).build()
+    router.add_handler(TypeHandler(Update, route))
+    router.job_queue.run_repeating(check_workers, interval=WORKER_CHECK_INTERVAL, name='check_workers')
+
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(shards)]
+    workers = []
+    failed = []
+    for index in range(shards):
+        worker_settings = dict(settings, global_rate=settings['global_rate'] / shards)
+        if settings.get('metrics_port') is not None:
+            worker_settings['metrics_port'] = settings['metrics_port'] + index
+        if settings.get('journal_path') is not None:
+            worker_settings['journal_path'] = settings['journal_path'] / f'shard-{index}'
+        if settings.get('profile_path') is not None:
+            worker_settings['profile_path'] = settings['profile_path'] / f'shard-{index}'
+        worker_settings['shard_stats_path'] = persistence_path / 'shards' / 'stats' / f'{index}.pickle'
+        workers.append(context.Process(
+            target=run_worker, name=f'gryphon-shard-{index}',
+            args=(index, token, shard_path(persistence_path, index, shards), backend, queues[index], worker_settings)))
+    if hasattr(signal, 'SIGHUP'):  # Not on Windows
+        signal.signal(signal.SIGHUP, forward_sighup)
+    try:
+        for worker in workers:
+            worker.start()
+        serve(router, mode, **webhook_settings)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            if worker.pid is not None:  # Started
+                worker.join()
+    if failed:
+        raise typer.Exit(code=1)
+
+
+async def _open_shard(path: Path, backend: PersistenceBackend) \
+        -> tuple[BasePersistence, Iterable, Iterable, dict]:
+    """
+    Open a shard's persistence for reading
+    :return: Tuple of (persistence, chat data, user data, bot data), with chat and user data as iterables of (id, data)
+    """
+    if backend == PersistenceBackend.sqlite:
+        persistence = SQLitePersistence(path / 'persistence.sqlite3')
+        return (persistence, persistence.iter_chat_data(), persistence.iter_user_data(),
+                await persistence.get_bot_data())
+    persistence = PicklePersistence(path / 'persistence.pkl', on_flush=True)
+    return (persistence, (await persistence.get_chat_data()).items(), (await persistence.get_user_data()).items(),
+            await persistence.get_bot_data())
+
+
+async def _rebalance(persistence_path: Path, shards: int, backend: PersistenceBackend) -> None:
+    current = get_shard_count(persistence_path)
+    staging = persistence_path / 'shards.new'
+    if staging.exists():
+        shutil.rmtree(staging)
+
+    targets = [make_persistence(staging / str(i), backend, on_flush=True) for i in range(shards)]
+    for target in targets:
+        # Pickle persistence only saves data it was asked to load, and every shard needs all of it
+        await target.get_chat_data()
+        await target.get_user_data()
+        await target.get_bot_data()
+    counts = [0] * shards
+    merged_bot_data = {}
+    for index in range(current):
+        source, chat_data, user_data, bot_data = await _open_shard(shard_path(persistence_path, index, current),
+                                                                   backend)
+        for n, (chat_id, data) in enumerate(chat_data):
+            target = shard_for(chat_id, shards)
+            await targets[target].update_chat_data(chat_id, data)
+            counts[target] += 1
+            if n % 1000 == 0:
+                await asyncio.sleep(0)  # Let SQLite persistence commit
+        for user_id, data in user_data:
+            await targets[shard_for(user_id, shards)].update_user_data(user_id, data)
+        if index == 0:
+            # Not split by chat, so it stays with the first shard
+            merged_bot_data.update((key, value) for key, value in bot_data.items() if key != 'stats')
+        if 'stats' in bot_data:
+            # Each shard counted its own chats, so the totals of all of them go to the first shard
+            get_global_stats(merged_bot_data).merge(bot_data['stats'])
+        await source.flush()
+    await targets[0].update_bot_data(merged_bot_data)
+    for target in targets:
+        await target.flush()
+    logger.info("Chats per shard: %s", counts)
+
+    # Keep the old layout, and put the new one in its place
+    backup = persistence_path / f"backup-{datetime.now():%Y%m%d-%H%M%S-%f}"
+    backup.mkdir()
+    for path in [*persistence_path.glob('persistence.*'), persistence_path / 'shards', persistence_path / MANIFEST]:
+        if path.exists():
+            path.rename(backup / path.name)
+    if shards == 1:
+        for path in (staging / '0').iterdir():
+            path.rename(persistence_path / path.name)
+        shutil.rmtree(staging)
+    else:
+        staging.rename(persistence_path / 'shards')
+        (persistence_path / MANIFEST).write_text(json.dumps({'shards': shards}))
+    logger.info("Moved the previous persistence to %s", backup)
+
+
+def rebalance(persistence_path: Annotated[Path, typer.Argument(help='Where persistence files are saved')],
+              shards: Annotated[int, typer.Option(min=1, help='Number of shards to split chats between')],
+              persistence_backend: Annotated[PersistenceBackend, typer.Option()] = PersistenceBackend.pickle) \
+        -> None:
+    """Move chats between shards for a new number of worker processes. Run while the bot is stopped."""
+    asyncio.run(_rebalance(persistence_path, shards, persistence_backend))
+
+
+if __name__ == "__main__":
+    typer.run(rebalance)
@@ -0,0 +1,125 @@
+"""
+Monte Carlo balance simulator for the food catalog: runs many hunts and whole gryphon lifetimes per category with
+NumPy, sampling exactly like Foods.get_food and Food.outcome, and reports outcome rates and lifespans as JSON.
+"""
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Optional
+
+import typer
+from typing_extensions import Annotated
+
+try:
+    import numpy as np
+except ImportError:  # Optional, install with the simulation extra
+    np = None
+
+from .food import AliasSampler, Foods, foods, load_foods
+
+ANY_CATEGORY = 'Any'
+
+
+class Simulator(object):
+    """Vectorized hunts over a food catalog."""
+
+    def __init__(self, catalog: Foods, seed: int = None):
+        if np is None:
+            raise RuntimeError("The simulator needs numpy, install gryphon-telegram-bot[simulation]")
+        self.catalog = catalog
+        self.rng = np.random.default_rng(seed)
+        self.success_rate = np.array([food.success_rate for food in catalog.foods])
+        self.death_threshold = np.array([food.death_threshold for food in catalog.foods])
+        self._index = {id(food): i for i, food in enumerate(catalog.foods)}
+
+    def _sampler(self, category: Optional[str]) -> AliasSampler:
+        return self.catalog.sampler if category is None else self.catalog.samplers[category]
+
+    def sample_foods(self, category: Optional[str], shape) -> np.ndarray:
+        """Indices into catalog.foods, drawn like AliasSampler.sample"""
+        sampler = self._sampler(category)
+        items = np.array([self._index[id(food)] for food in sampler.items])
+        probability, alias = np.array(sampler.probability), np.array(sampler.alias)
+        u = self.rng.random(shape) * len(items)
+        i = u.astype(np.intp)
+        return items[np.where(u - i < probability[i], i, alias[i])]
+
+    def outcomes(self, food: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """:return: Tuple of (success, died) arrays, decided like Food.outcome"""
+        u = self.rng.random(food.shape)
+        success = u < self.success_rate[food]
+        return success, ~success & (u < self.death_threshold[food])
+
+    def death_probability(self, category: Optional[str]) -> float:
+        """Exact chance that a single hunt is fatal"""
+        sampler = self._sampler(category)
+        items = np.array([self._index[id(food)] for food in sampler.items])
+        weights = np.array([food.rarity for food in sampler.items])
+        return float(weights @ (self.death_threshold - self.success_rate)[items] / weights.sum())
+
+    def hunts(self, category: Optional[str], n: int, batch: int = 1_000_000) -> dict:
+        """Outcome rates of n hunts, overall and per food"""
+        counts = np.zeros((len(self.catalog.foods), 3), dtype=np.int64)  # caught, missed, died
+        for start in range(0, n, batch):
+            food = self.sample_foods(category, min(batch, n - start))
+            success, died = self.outcomes(food)
+            outcome = np.where(success, 0, np.where(died, 2, 1))
+            np.add.at(counts, (food, outcome), 1)
+
+        total = counts.sum(axis=0)
+        return {'hunts': n,
+                'caught': total[0] / n, 'missed': total[1] / n, 'died': total[2] / n,
+                'expected_died': self.death_probability(category),
+                'foods': {food.name: {'share': int(row.sum()) / n,
+                                      'caught': int(row[0]) / max(int(row.sum()), 1),
+                                      'died': int(row[2]) / max(int(row.sum()), 1)}
+                          for food, row in zip(self.catalog.foods, counts) if row.sum()}}
+
+    def lifetimes(self, category: Optional[str], n: int, max_hunts: int = 100_000, chunk: int = 64) -> dict:
+        """
+        Lifespans of n gryphons that only ever hunt in one category, counted in hunts including the fatal one
+        :param max_hunts: Gryphons still alive after this many hunts are counted as living this long
+        :param chunk: Hunts simulated per gryphon per step
+        """
+        lifespans = np.full(n, max_hunts, dtype=np.int64)
+        alive = np.arange(n)
+        hunted = 0
+        while alive.size and hunted < max_hunts:
+            _, died = self.outcomes(self.sample_foods(category, (alive.size, chunk)))
+            dead = died.any(axis=1)
+            lifespans[alive[dead]] = np.minimum(hunted + died[dead].argmax(axis=1) + 1, max_hunts)
+            alive = alive[~dead]
+            hunted += chunk
+
+        p = self.death_probability(category)
+        return {'gryphons': n,
+                'mean_hunts': float(lifespans.mean()),
+                'expected_mean_hunts': 1 / p if p else None,
+                'p10_hunts': float(np.percentile(lifespans, 10)),
+                'p50_hunts': float(np.percentile(lifespans, 50)),
+                'p90_hunts': float(np.percentile(lifespans, 90)),
+                'survived': int(alive.size)}
+
+    def report(self, hunts: int, lifetimes: int) -> dict:
+        return {category or ANY_CATEGORY: {'outcomes': self.hunts(category, hunts),
+                                           'lifespan': self.lifetimes(category, lifetimes)}
+                for category in [None, *self.catalog.categories]}
+
+
+def simulate(hunts: Annotated[int, typer.Option(help='Hunts to simulate per category')] = 1_000_000,
+             lifetimes: Annotated[int, typer.Option(help='Gryphon lifetimes to simulate per category')] = 100_000,
+             seed: Annotated[int, typer.Option(help='Random seed')] = None,
+             catalog: Annotated[Path, typer.Option(help='Food catalog file to try, instead of the one in use')] = None,
+             output: Annotated[Path, typer.Option(help='Write results to this file instead of stdout')] = None) \
+        -> None:
+    """Simulate hunts with the food catalog, to see how rarity, success rate and death chance play out."""
+    results = Simulator(foods.current if catalog is None else load_foods(catalog), seed).report(hunts, lifetimes)
+    if output is None:
+        typer.echo(json.dumps(results, indent=2))
+    else:
+        output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(simulate)
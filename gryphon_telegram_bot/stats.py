@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import logging
+import os
+import pickle
+from collections import Counter
+from pathlib import Path
+from typing import Hashable, Union
+
+from .food import HuntOutcome
+from .gryphon import Gryphon, GryphonRecord, format_duration
+
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_SIZE = 5
+SHARD_STATS_INTERVAL = 10.
+
+
+class Leaderboard(object):
+    """The entries with the highest scores, where an entry's score can be raised again later."""
+
+    def __init__(self, size: int = LEADERBOARD_SIZE):
+        self.size = size
+        self.entries: dict[Hashable, tuple[float, str]] = {}  # Score and label by key
+
+    def offer(self, key: Hashable, score: float, label: str) -> None:
+        if key in self.entries or len(self.entries) < self.size:
+            self.entries[key] = (score, label)
+            return
+        lowest = min(self.entries, key=lambda k: self.entries[k][0])
+        if score > self.entries[lowest][0]:
+            del self.entries[lowest]
+            self.entries[key] = (score, label)
+
+    def top(self) -> list[tuple[float, str]]:
+        return sorted(self.entries.values(), reverse=True)
+
+    def merge(self, other: Leaderboard) -> None:
+        for key, (score, label) in other.entries.items():
+            self.offer(key, score, label)
+
+
+class Stats(object):
+    """Counters for a chat or all chats, updated as things happen so they can be shown without scanning anything."""
+
+    def __init__(self):
+        self.births = 0
+        self.deaths = 0
+        self.hunts = 0
+        self.catches = 0
+        self.caught: Counter[str] = Counter()  # Catches by food
+        self.killed_by: Counter[str] = Counter()  # Deaths by the food being hunted
+        self.longest_lived = Leaderboard()  # Gryphons that are gone, by lifetime in seconds
+        self.most_hunts = Leaderboard()
+        self.gryphon_hunts = 0  # Hunts of the chat's current gryphon, only used in chat stats
+
+    def merge(self, other: Stats) -> None:
+        """Add the counts of other, e.g. the global stats of another shard, which counted different chats"""
+        self.births += other.births
+        self.deaths += other.deaths
+        self.hunts += other.hunts
+        self.catches += other.catches
+        self.caught.update(other.caught)
+        self.killed_by.update(other.killed_by)
+        self.longest_lived.merge(other.longest_lived)
+        self.most_hunts.merge(other.most_hunts)
+
+    def end(self, key: Hashable, record: GryphonRecord) -> None:
+        self.longest_lived.offer(key, record.deathday - record.birthday, record.name)
+
+    def format(self) -> str:
+        def ranking(items: list[tuple[str, object]]) -> str:
+            return ", ".join(f"{label} ({value})" for label, value in items) or "none yet"
+
+        lines = [f"Gryphons: {self.births} summoned, {self.deaths} died",
+                 f"Hunts: {self.hunts}, {self.catches / self.hunts:.0%} caught" if self.hunts else "Hunts: 0",
+                 "Longest lived: " + ranking([(name, format_duration(age))
+                                              for age, name in self.longest_lived.top()]),
+                 "Most hunts: " + ranking([(name, f"{hunts:.0f}") for hunts, name in self.most_hunts.top()]),
+                 "Top foods caught: " + ranking([(food, n) for food, n in self.caught.most_common(3)])]
+        if self.killed_by:
+            food, n = self.killed_by.most_common(1)[0]
+            lines.append(f"Most common cause of death: hunting a {food} ({n})")
+        return "\n".join(lines)
+
+
+def get_chat_stats(chat_data: dict) -> Stats:
+    stats = chat_data.get('stats')
+    if stats is None:
+        stats = chat_data['stats'] = Stats()
+        for record in chat_data.get('history', []):  # Gryphons from before stats were kept
+            stats.end((None, record.birthday), record)
+    return stats
+
+
+def get_global_stats(bot_data: dict) -> Stats:
+    stats = bot_data.get('stats')
+    if stats is None:
+        stats = bot_data['stats'] = Stats()
+    return stats
+
+
+class ShardStats(object):
+    """
+    Global stats of a bot split into shards, each of which only counts its own chats. Every shard saves its stats to
+    a file in a directory they share, and adds up the latest files of the others to show stats of all chats.
+    """
+
+    def __init__(self, path: Path):
+        """:param path: File this shard saves its stats to, the other files in its directory are the other shards'"""
+        self.path = Path(path)
+        self._others: dict[Path, tuple[int, Stats]] = {}  # Stats of other shards and the file's mtime they're from
+
+    def save(self, stats: Stats) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_suffix('.tmp')
+        with open(temporary, 'wb') as f:
+            pickle.dump(stats, f)
+        os.replace(temporary, self.path)  # So other shards never read half a file
+
+    def _load(self, path: Path) -> Union[Stats, None]:
+        try:
+            mtime = path.stat().st_mtime_ns
+            if path not in self._others or self._others[path][0] != mtime:
+                with open(path, 'rb') as f:
+                    self._others[path] = (mtime, pickle.load(f))
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logger.warning("Could not read the stats of another shard from %s: %s", path, e)
+            return None
+        return self._others[path][1]
+
+    def total(self, stats: Stats) -> Stats:
+        """:param stats: This shard's own global stats"""
+        total = Stats()
+        total.merge(stats)
+        for path in sorted(self.path.parent.glob('*' + self.path.suffix)):
+            if path != self.path and (other := self._load(path)) is not None:
+                total.merge(other)
+        return total
+
+
+def record_birth(chat_data: dict, bot_data: dict, chat_id: int, gryphon: Gryphon,
+                 previous: Union[GryphonRecord, None]) -> None:
+    """:param previous: Record of the gryphon the new one replaces, if any"""
+    chat_stats, global_stats = get_chat_stats(chat_data), get_global_stats(bot_data)
+    for stats, key in ((chat_stats, None), (global_stats, chat_id)):
+        stats.births += 1
+        if previous is not None:
+            stats.end((key, previous.birthday), previous)
+    chat_stats.gryphon_hunts = 0
+
+
+def record_hunt(chat_data: dict, bot_data: dict, chat_id: int, gryphon: Gryphon, outcome: HuntOutcome) -> None:
+    chat_stats, global_stats = get_chat_stats(chat_data), get_global_stats(bot_data)
+    chat_stats.gryphon_hunts += 1
+    for stats, key in ((chat_stats, None), (global_stats, chat_id)):
+        stats.hunts += 1
+        stats.most_hunts.offer((key, gryphon.birthday), chat_stats.gryphon_hunts, gryphon.name)
+        if outcome.success:
+            stats.catches += 1
+            stats.caught[outcome.food.name] += 1
+        if outcome.died:
+            stats.deaths += 1
+            stats.killed_by[outcome.food.name] += 1
+            stats.end((key, gryphon.birthday), gryphon.record())
+
+
+def format_stats(chat_data: dict, global_stats: Stats) -> str:
+    return (f"Gryphons of this chat\n{get_chat_stats(chat_data).format()}\n\n"
+            f"Gryphons of all chats\n{global_stats.format()}")